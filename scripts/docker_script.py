@@ -24,6 +24,7 @@ from ellis_island.utils.smartopen import prefix_path_from_uri, ParseUri
 
 from superserial import SQLStash, file_stash, Gula
 from superserial.stashtofile import S3FileStashPool
+from superserial.stashindex import default_index_path
 
 # Imports for script portion.
 import click
@@ -80,6 +81,13 @@ TESTHELP = '''If test mode,the meta table will end with the projects name.
               help='The number of IO threads. If 1, no threads will be used.')
 @click.option('-iob', default=200, type=int,
               help='The IO batch size.')
+@click.option('-ioq', default=0, type=int,
+              help='Per stash writer queue depth. If 0, stash inline.')
+@click.option('--resume/--no-resume', default=False,
+              help="Skip files the manifests of a previous run hold.")
+@click.option('--manifestdir', default='/mnt/output/manifests/',
+              help='Where to keep the manifests of the written files. '
+                   'Should outlive the container.')
 def main(inputdir,
          meta,
          datafile,
@@ -97,7 +105,10 @@ def main(inputdir,
          log,
          ioc,
          iot,
-         iob):
+         iob,
+         ioq,
+         resume,
+         manifestdir):
     starttime = now()
     count = n  # TODO (steven_c) clean this up
     vcores = c
@@ -181,11 +192,24 @@ def main(inputdir,
     # sdbase.default_create_table_sqlalchemy(meta, tablename=metatable)
     stashobjdict = {  # 'meta': SQLStash(uri=meta, table=metatable),
                     'text': file_stash(parenturi=outroottext,
+                                       manifest=default_index_path(
+                                           outroottext, name='manifest',
+                                           indexdir=manifestdir),
                                        **iogenargs),
                     'raw': file_stash(parenturi=outrootraw,
+                                      manifest=default_index_path(
+                                          outrootraw, name='manifest',
+                                          indexdir=manifestdir),
                                       **iogenargs),
                     }
-    chomp = Gula(**stashobjdict)
+    if resume and ParseUri(datafile).scheme in {'s3'}:
+        # One bulk listing per output, in case the manifests missed uploads.
+        for stashobj in stashobjdict.values():
+            stashobj.seed_manifest()
+    if ioq > 0:
+        chomp = Gula.queued(queuedepth=ioq, **stashobjdict)
+    else:
+        chomp = Gula(**stashobjdict)
 
     def rm_meta(rpackiter):
         for pack in rpackiter:
@@ -193,7 +217,7 @@ def main(inputdir,
             yield pack
 
     rpckitr = rm_meta(respackiter)
-    chomp.consume(rpckitr)
+    chomp.consume(rpckitr, resume=resume)
     LOG.info('\t'.join(['VCores:',
                         str(vcores),
                         ]))
@@ -41,5 +41,8 @@ setup(
                       'dataset',
                       'arrow',
                       'boto3',
+                      'futures',
                       ],
+    extras_require={'dedup': ['xxhash'],
+                    },
 )
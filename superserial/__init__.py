@@ -6,14 +6,21 @@ Copyright: superserial  Copyright (C) 2015  Steven Cutting
 """
 from superserial.__about__ import *
 from superserial.stashenmasse import(Gula,
+                                     AsyncGula,
+                                     ExecutorStash,
+                                     QueuedStash,
                                      stash_en_masse,
                                      EnMasseStash)
 from superserial.stashtofile import(file_stash,
                                     S3FileStash,
-                                    LocalFileStash)
+                                    LocalFileStash,
+                                    PackFileStash,
+                                    PackFileReader)
 from superserial.stashtodatabase import SQLStash
 
 __all__ = ["stash_en_masse", "EnMasseStash", "file_stash",
            "S3FileStash", "LocalFileStash", "SQLStash",
-           "Gula",
+           "PackFileStash", "PackFileReader",
+           "Gula", "AsyncGula", "ExecutorStash",
+           "QueuedStash",
            ]
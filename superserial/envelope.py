@@ -0,0 +1,628 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Steven Cutting'
+__author_email__ = 'steven.e.cutting@linux.com'
+__created_on__ = '8/31/2015'
+__copyright__ = "superserial  Copyright (C) 2015  Steven Cutting"
+
+from . import(__title__, __version__, __status__, __license__, __maintainer__,
+              __email__)
+
+
+import logging
+LOG = logging.getLogger(__name__)
+
+import os
+import zlib
+import time
+import struct
+import base64
+from io import BytesIO
+from functools import partial
+from multiprocessing import cpu_count
+from threading import Lock, local
+
+from concurrent.futures import ProcessPoolExecutor
+
+from pathlib import PurePath
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.exceptions import InvalidTag
+except ImportError:
+    AESGCM = None
+
+from superserial.utils import pass_through, encrypt_it
+
+
+# ------------------------------------------------------------------------------
+# Compression
+
+class GzipCodec(object):
+    name = 'gzip'
+    extension = '.gz'
+    contentencoding = 'gzip'
+    defaultlevel = 6
+
+    def __init__(self, level=None):
+        self.level = self.defaultlevel if level is None else level
+
+    def compressobj(self):
+        """
+        Streaming compressor, has compress(data) and flush() methods.
+        """
+        # wbits of 16 + MAX_WBITS gives the gzip container.
+        return zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        compressor = self.compressobj()
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+class ZstdCodec(GzipCodec):
+    name = 'zstd'
+    extension = '.zst'
+    contentencoding = 'zstd'
+    defaultlevel = 3
+
+    def __init__(self, level=None):
+        if zstandard is None:
+            raise ImportError('zstd compression needs the zstandard library')
+        super(ZstdCodec, self).__init__(level=level)
+        # ZstdCompressor isn't thread safe and codecs are shared by the
+        # compressworkers threads, so each thread gets its own.
+        self.local = local()
+
+    @property
+    def compressor(self):
+        try:
+            return self.local.compressor
+        except AttributeError:
+            self.local.compressor = zstandard.ZstdCompressor(level=self.level)
+            return self.local.compressor
+
+    def compressobj(self):
+        return self.compressor.compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+class _Lz4Compressor(object):
+    def __init__(self, level):
+        self.compressor = lz4frame.LZ4FrameCompressor(compression_level=level)
+        self.started = False
+
+    def compress(self, data):
+        if not self.started:
+            self.started = True
+            return self.compressor.begin() + self.compressor.compress(data)
+        return self.compressor.compress(data)
+
+    def flush(self):
+        if not self.started:
+            return self.compress(b'') + self.compressor.flush()
+        return self.compressor.flush()
+
+
+class Lz4Codec(GzipCodec):
+    name = 'lz4'
+    extension = '.lz4'
+    contentencoding = 'lz4'
+    defaultlevel = 0
+
+    def __init__(self, level=None):
+        if lz4frame is None:
+            raise ImportError('lz4 compression needs the lz4 library')
+        super(Lz4Codec, self).__init__(level=level)
+
+    def compressobj(self):
+        return _Lz4Compressor(self.level)
+
+    def compress(self, data):
+        return lz4frame.compress(data, compression_level=self.level)
+
+    def decompress(self, data):
+        return lz4frame.decompress(data)
+
+
+CODECS = {'gzip': GzipCodec,
+          'zstd': ZstdCodec,
+          'lz4': Lz4Codec,
+          }
+
+
+def get_codec(compress, level=None):
+    """
+    compress - None, a codec name ('gzip', 'zstd', 'lz4') or a codec object.
+    """
+    if compress is None or compress is False:
+        return None
+    elif isinstance(compress, basestring):
+        try:
+            return CODECS[compress](level=level)
+        except KeyError:
+            raise ValueError('compress should be one of: ' +
+                             ', '.join(sorted(CODECS)))
+    return compress
+
+
+# ------------------------------------------------------------------------------
+# AEAD
+#
+# Chunked AES-256-GCM, raw binary output:
+#   header: magic 'SSAE', algorithm (1 byte), chunksize (4 bytes), salt (16)
+#   chunks: plaintext length (4 bytes), ciphertext and 16 byte tag
+# Every chunk but the last holds exactly chunksize bytes of plaintext, so a
+# byte range can be decrypted by seeking straight to its chunks.
+# Each object's key is derived (HKDF-SHA256) from the data key and the salt.
+# The nonce is the chunk counter, and the associated data is the header, the
+# counter and a final-chunk flag, so chunks can't be reordered, dropped or
+# truncated without decryption failing.
+
+AEADMAGIC = b'SSAE'
+AEADAESGCM = 1
+AEADCHUNKSIZE = 64 * 1024
+_AEADHEADER = struct.Struct('>4sBI16s')
+_AEADCHUNK = struct.Struct('>I')
+_AEADTAG = 16
+
+
+def _key_material(encryptkey):
+    """
+    The raw bytes of a Fernet data key (32 bytes, urlsafe base64 encoded),
+    raises ValueError for anything else, as Fernet does.
+    """
+    if not isinstance(encryptkey, basestring):
+        raise ValueError('aead envelopes need a Fernet key, got ' +
+                         type(encryptkey).__name__)
+    try:
+        keymaterial = base64.urlsafe_b64decode(bytes(encryptkey))
+    except (TypeError, ValueError, UnicodeError):
+        keymaterial = b''
+    if len(keymaterial) != 32:
+        raise ValueError('aead envelopes need a Fernet key, 32 url-safe '
+                         'base64-encoded bytes')
+    return keymaterial
+
+
+class AeadCipher(object):
+    """
+    Encrypts and decrypts the chunked AES-GCM format described above.
+
+    encryptkey - the data key, the same key as for Fernet.
+    chunksize - plaintext bytes per chunk; memory use is bounded by it.
+    """
+    def __init__(self, encryptkey, chunksize=AEADCHUNKSIZE):
+        if AESGCM is None:
+            raise ImportError('aead envelopes need cryptography >= 2.0')
+        self.keymaterial = _key_material(encryptkey)
+        self.chunksize = chunksize
+
+    def _aesgcm(self, salt):
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt,
+                    info=b'superserial aead', backend=default_backend())
+        return AESGCM(hkdf.derive(self.keymaterial))
+
+    @staticmethod
+    def _nonce(counter):
+        return struct.pack('>QI', 0, counter)
+
+    @staticmethod
+    def _aad(header, counter, final):
+        return header + struct.pack('>IB', counter, int(final))
+
+    def header(self):
+        salt = os.urandom(16)
+        return _AEADHEADER.pack(AEADMAGIC, AEADAESGCM, self.chunksize,
+                                salt), salt
+
+    def encrypt_chunks(self, fileobj):
+        """
+        Yields the header and then the sealed chunks of fileobj's content.
+        """
+        header, salt = self.header()
+        aesgcm = self._aesgcm(salt)
+        yield header
+        counter = 0
+        chunk = _read_full(fileobj, self.chunksize)
+        while True:
+            nextchunk = _read_full(fileobj, self.chunksize)
+            final = not nextchunk
+            yield (_AEADCHUNK.pack(len(chunk)) +
+                   aesgcm.encrypt(self._nonce(counter), chunk,
+                                  self._aad(header, counter, final)))
+            if final:
+                return
+            chunk = nextchunk
+            counter += 1
+
+    def encrypt(self, content):
+        return b''.join(self.encrypt_chunks(BytesIO(_to_bytes(content))))
+
+    def encrypt_stream(self, fileobj):
+        """
+        File-like object reading the encryption of fileobj.
+        """
+        return _ChunkReader(self.encrypt_chunks(fileobj))
+
+    def _read_header(self, fileobj):
+        header = _read_full(fileobj, _AEADHEADER.size)
+        if len(header) != _AEADHEADER.size:
+            raise ValueError('Not an aead envelope, too short')
+        magic, algorithm, chunksize, salt = _AEADHEADER.unpack(header)
+        if magic != AEADMAGIC or algorithm != AEADAESGCM:
+            raise ValueError('Not an aead envelope')
+        return header, chunksize, self._aesgcm(salt)
+
+    def _open_chunk(self, fileobj, aesgcm, header, chunksize, counter):
+        """
+        Returns (plaintext, final) for the chunk at fileobj's position, or
+        None at the end of the data.
+        """
+        prefix = _read_full(fileobj, _AEADCHUNK.size)
+        if not prefix:
+            return None
+        length, = _AEADCHUNK.unpack(prefix)
+        if length > chunksize:
+            raise ValueError('Corrupt aead envelope, bad chunk length')
+        sealed = _read_full(fileobj, length + _AEADTAG)
+        nonce = self._nonce(counter)
+        if length == chunksize:
+            # A full chunk can be the last one too, only its tag tells.
+            try:
+                return (aesgcm.decrypt(nonce, sealed,
+                                       self._aad(header, counter, False)),
+                        False)
+            except InvalidTag:
+                pass
+        return (aesgcm.decrypt(nonce, sealed, self._aad(header, counter, True)),
+                True)
+
+    def decrypt_chunks(self, fileobj):
+        """
+        Yields the plaintext of fileobj's envelope a chunk at a time.
+        Raises cryptography's InvalidTag if the data was tampered with, or
+        ValueError if it was truncated.
+        """
+        header, chunksize, aesgcm = self._read_header(fileobj)
+        counter = 0
+        while True:
+            opened = self._open_chunk(fileobj, aesgcm, header, chunksize,
+                                      counter)
+            if opened is None:
+                raise ValueError('Truncated aead envelope')
+            plaintext, final = opened
+            yield plaintext
+            if final:
+                return
+            counter += 1
+
+    def decrypt(self, data):
+        return b''.join(self.decrypt_chunks(BytesIO(data)))
+
+    def decrypt_range(self, fileobj, start, stop):
+        """
+        Returns plaintext bytes [start, stop) from a seekable fileobj, only
+        reading and decrypting the chunks that hold them.
+        """
+        header, chunksize, aesgcm = self._read_header(fileobj)
+        sealedsize = _AEADCHUNK.size + chunksize + _AEADTAG
+        first = start // chunksize
+        fileobj.seek(_AEADHEADER.size + first * sealedsize)
+        parts = []
+        counter = first
+        while counter * chunksize < stop:
+            opened = self._open_chunk(fileobj, aesgcm, header, chunksize,
+                                      counter)
+            if opened is None:
+                break
+            plaintext, final = opened
+            parts.append(plaintext)
+            if final:
+                break
+            counter += 1
+        offset = start - first * chunksize
+        return b''.join(parts)[offset:offset + stop - start]
+
+
+def _read_full(fileobj, size):
+    """
+    Reads 'size' bytes, less only at the end of fileobj.
+    """
+    parts = []
+    while size > 0:
+        data = fileobj.read(size)
+        if not data:
+            break
+        parts.append(data)
+        size -= len(data)
+    return b''.join(parts)
+
+
+class _ChunkReader(object):
+    """
+    Read only file-like object over an iterator of byte strings.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def read(self, size=-1):
+        parts = [self.buffer]
+        buffered = len(self.buffer)
+        while size < 0 or buffered < size:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                break
+            parts.append(chunk)
+            buffered += len(chunk)
+        data = b''.join(parts)
+        if size < 0:
+            self.buffer = b''
+            return data
+        data, self.buffer = data[:size], data[size:]
+        return data
+
+
+_AEADCIPHERS = {}
+
+
+def aead_cipher(encryptkey):
+    """
+    One AeadCipher per key for the process.
+    """
+    try:
+        return _AEADCIPHERS[encryptkey]
+    except KeyError:
+        cipher = _AEADCIPHERS[encryptkey] = AeadCipher(encryptkey)
+        return cipher
+
+
+def aead_encrypt(content, key):
+    return aead_cipher(key).encrypt(content)
+
+
+def aead_decrypt(data, key):
+    return aead_cipher(key).decrypt(data)
+
+
+# ------------------------------------------------------------------------------
+# Envelopes
+
+def _to_bytes(content):
+    if isinstance(content, unicode):
+        return content.encode('utf-8')
+    return str(content)
+
+
+def _compress_then(content, codec, then):
+    return then(codec.compress(_to_bytes(content)))
+
+
+ENVELOPES = {'fernet', 'aead'}
+
+
+def _check_envelope(envelope):
+    if envelope not in ENVELOPES:
+        raise ValueError('envelope should be one of: ' +
+                         ', '.join(sorted(ENVELOPES)))
+
+
+def make_envelope(encrypt=False, encryptkey=None, codec=None,
+                  envelope='fernet'):
+    """
+    Returns the function a stash applies to each datum's content: compress
+    with 'codec' (if given), then encrypt (if 'encrypt').
+    Compression comes first since ciphertext doesn't compress.
+
+    envelope - 'fernet' (base64 text) or 'aead' (chunked AES-GCM, binary
+               and about a third smaller, see AeadCipher).
+    """
+    _check_envelope(envelope)
+    if encrypt and envelope == 'aead':
+        seal = partial(aead_encrypt, key=encryptkey)
+    elif encrypt:
+        seal = partial(encrypt_it, key=encryptkey)
+    else:
+        seal = pass_through
+    if codec is None:
+        return seal
+    return partial(_compress_then, codec=codec, then=seal)
+
+
+class CompressingReader(object):
+    """
+    Read only file-like object that compresses 'fileobj' with 'codec' as it
+    is read, so a large body can be streamed without holding it in memory.
+    """
+    def __init__(self, fileobj, codec, blocksize=1024 ** 2):
+        self.fileobj = fileobj
+        self.compressor = codec.compressobj()
+        self.blocksize = blocksize
+        self.buffer = b''
+        self.done = False
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            data = self.fileobj.read(self.blocksize)
+            if data:
+                self.buffer += self.compressor.compress(data)
+            else:
+                self.buffer += self.compressor.flush()
+                self.done = True
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def is_stream(content):
+    """
+    True for content given as a file-like object or a path to a file.
+    """
+    return hasattr(content, 'read') or isinstance(content, PurePath)
+
+
+def make_stream_envelope(encrypt=False, encryptkey=None, codec=None,
+                         envelope='fernet'):
+    """
+    Like make_envelope, but for file-like content: returns a function that
+    wraps a file-like object into an enveloped file-like object.
+    Compression and aead encryption are streamed; Fernet encryption needs
+    the whole content, so Fernet encrypted streams are read into memory.
+    """
+    _check_envelope(envelope)
+    if encrypt and envelope == 'aead':
+        cipher = aead_cipher(encryptkey)
+        if codec is None:
+            return cipher.encrypt_stream
+
+        def seal_stream(fileobj):
+            return cipher.encrypt_stream(CompressingReader(fileobj, codec))
+        return seal_stream
+    elif encrypt:
+        envelope = make_envelope(encrypt, encryptkey, codec)
+
+        def seal_stream(fileobj):
+            LOG.debug('Encrypting a stream, reading it into memory.')
+            return BytesIO(envelope(fileobj.read()))
+        return seal_stream
+    elif codec is not None:
+        return partial(CompressingReader, codec=codec)
+    return pass_through
+
+
+def envelope_pointer(pointer, encrypt=False, removeExtIfEncrypt=True,
+                     codec=None):
+    """
+    The name content is stored under: without its extension when encrypted
+    (if removeExtIfEncrypt), with the codec's extension when only compressed.
+    """
+    if encrypt and removeExtIfEncrypt:
+        return pointer.split('.')[0]
+    elif codec is not None and not encrypt:
+        return pointer + codec.extension
+    return pointer
+
+
+def envelope_s3_args(encrypt=False, codec=None):
+    """
+    Extra put_object args describing the envelope.
+    """
+    if codec is not None and not encrypt:
+        return {'ContentEncoding': codec.contentencoding}
+    return {}
+
+
+# ------------------------------------------------------------------------------
+# Encryption Stage
+
+_STAGEENVELOPES = {}
+
+
+def _envelope_batch(envelopeargs, contents):
+    """
+    Runs in the EncryptionStage's worker processes, which keep one envelope
+    (and so one cipher object) per set of envelope args.
+    """
+    try:
+        envelope = _STAGEENVELOPES[envelopeargs]
+    except KeyError:
+        encryptkey, codecname, level, mode = envelopeargs
+        envelope = make_envelope(True, encryptkey, get_codec(codecname, level),
+                                 envelope=mode)
+        _STAGEENVELOPES[envelopeargs] = envelope
+    return [envelope(content) for content in contents]
+
+
+class EncryptionStage(object):
+    """
+    Compresses (with 'codec', if given) and encrypts batches of content on
+    a pool of processes, since encryption is CPU bound and holds the GIL.
+
+    workers - number of processes, default is one per core.
+    batchsize - number of contents sent to a process at once.
+    envelope - 'fernet' or 'aead', see make_envelope.
+
+    envelope_many returns the sealed contents in the order they were given.
+    stats() reports the stage's own latency (per batch, from submission to
+    result) and throughput, apart from the writes and uploads that follow.
+    """
+    def __init__(self, encryptkey, codec=None, workers=None, batchsize=64,
+                 envelope='fernet'):
+        self.workers = workers or cpu_count()
+        self.batchsize = batchsize
+        if codec is None:
+            self.envelopeargs = (encryptkey, None, None, envelope)
+        else:
+            self.envelopeargs = (encryptkey, codec.name, codec.level, envelope)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.lock = Lock()
+        self.batches = 0
+        self.items = 0
+        self.nbytes = 0
+        self.seconds = 0.0
+        self.latencies = 0.0
+        self.maxlatency = 0.0
+
+    def envelope_many(self, contents):
+        starttime = time.time()
+        submitted = []
+        for i in xrange(0, len(contents), self.batchsize):
+            batch = contents[i:i + self.batchsize]
+            submitted.append((time.time(),
+                              self.executor.submit(_envelope_batch,
+                                                   self.envelopeargs,
+                                                   batch)))
+        sealed = []
+        for submittime, future in submitted:
+            result = future.result()
+            latency = time.time() - submittime
+            with self.lock:
+                self.batches += 1
+                self.items += len(result)
+                self.nbytes += sum(len(r) for r in result)
+                self.latencies += latency
+                self.maxlatency = max(self.maxlatency, latency)
+            sealed.extend(result)
+        with self.lock:
+            self.seconds += time.time() - starttime
+        return sealed
+
+    def stats(self):
+        with self.lock:
+            batches = self.batches or 1
+            seconds = self.seconds or float('inf')
+            return {'workers': self.workers,
+                    'batches': self.batches,
+                    'items': self.items,
+                    'bytes': self.nbytes,
+                    'seconds': self.seconds,
+                    'meanlatency': self.latencies / batches,
+                    'maxlatency': self.maxlatency,
+                    'itemspersecond': self.items / seconds,
+                    'bytespersecond': self.nbytes / seconds,
+                    }
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+        LOG.info('EncryptionStage stats:\t' + repr(self.stats()))
@@ -20,14 +20,28 @@ Functions to assist in parallel processing with Python 2.7.
 * Similar to joblib.Parallel but with the addition of imap functionality
   and a more effective way of handling Ctrl-C exit (we add a timeout).
 """
+import os
 import sys
+import time
+import atexit
+import shutil
+import tempfile
+import threading
+import traceback
 import itertools
-from multiprocessing import cpu_count, Pool, Process, Manager, Lock
+from collections import OrderedDict
+from six.moves import queue
+from functools import partial
+from multiprocessing import cpu_count, Pool, Process, Queue
 from multiprocessing.pool import IMapUnorderedIterator, IMapIterator
 try:
     import cPickle
 except ImportError:
     import pickle as cPickle
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 if sys.version_info[0] < 3:
     _STRINGTYPES = (basestring,)
@@ -42,41 +56,97 @@ else:
 ###############################################################################
 # Used as the timeout
 GOOGLE = 1e100
+# parallel_apply sends str payloads bigger than this (bytes) through a file
+# in shared memory (/dev/shm) rather than pickling them through a pipe.
+SHMTHRESHOLD = 256 * 1024
+SHMDIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
 
 
 ###############################################################################
 # Functions
 ###############################################################################
 
-def _do_work_off_queue(lock, in_q, func, out_q, sep):
+class _ShmRef(object):
+    """
+    Stands in for a large str payload parked in a shared memory file.
+    """
+    def __init__(self, path):
+        self.path = path
+
+
+def _to_wire(x, shmdir, threshold):
+    if shmdir is None or not isinstance(x, str) or len(x) <= threshold:
+        return x
+    fd, path = tempfile.mkstemp(dir=shmdir)
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(x)
+    return _ShmRef(path)
+
+
+def _from_wire(x):
+    if not isinstance(x, _ShmRef):
+        return x
+    with open(x.path, 'rb') as fp:
+        data = fp.read()
+    os.remove(x.path)
+    return data
+
+
+def _do_work_off_queue(in_q, func, out_q, sep, shmdir, threshold):
     while True:
-        x = in_q.get()
+        batch = in_q.get()
 
-        if x is None:
-            out_q.put(x)
+        if batch is None:
+            out_q.put(None)
             return
 
-        result = func(x)
-        out_q.put(str(result) + sep)
+        try:
+            results = [_to_wire(str(func(_from_wire(x))) + sep, shmdir,
+                                threshold)
+                       for x in batch]
+        except Exception:
+            out_q.put(traceback.format_exc())
+            continue
+        out_q.put(results)
 
 
-def _write_to_output(out_q, stream, n_jobs):
+def _write_to_output(out_q, stream, n_jobs, errors):
     ends_seen = 0
     while True:
-        x = out_q.get()
-        if not x:
+        batch = out_q.get()
+        if batch is None:
             ends_seen += 1
             if ends_seen == n_jobs:
                 stream.flush()
                 return
             else:
                 continue
-        stream.write(x)
+        if isinstance(batch, str):
+            errors.append(batch)
+            continue
+        for x in batch:
+            stream.write(_from_wire(x))
 
 
-def parallel_apply(func, iterable, n_jobs, sep='\n', out_stream=sys.stdout):
+def parallel_apply(func, iterable, n_jobs, sep='\n', out_stream=sys.stdout,
+                   batchsize=100, shmthreshold=SHMTHRESHOLD):
     """
     Writes the result of applying func to iterable using n_jobs to out_stream
+
+    Parameters
+    ----------
+    batchsize : Integer
+        Items (and results) are sent between processes batchsize at a time,
+        over plain multiprocessing queues (pipes).
+    shmthreshold : Integer
+        str items and results longer than this are passed through files in
+        /dev/shm instead of being pickled down the pipes. None to disable.
+        (multiprocessing.shared_memory isn't available in Python 2.7.)
+
+    Raises
+    ------
+    RuntimeError if func raised in a worker; the remaining batches are
+    still processed.
     """
     # if there is only one job, simply read from iterable, apply function
     # and write to outpu
@@ -86,38 +156,346 @@ def parallel_apply(func, iterable, n_jobs, sep='\n', out_stream=sys.stdout):
         out_stream.flush()
         return
 
-    # if there is more than one job, use a queue manager to communicate
+    # if there is more than one job, use plain queues to communicate
     # between processes.
-    manager = Manager()
-    in_q = manager.Queue(maxsize=2 * n_jobs)
-    out_q = manager.Queue(maxsize=2 * n_jobs)
-    lock = Lock()
+    in_q = Queue(maxsize=2 * n_jobs)
+    out_q = Queue(maxsize=2 * n_jobs)
+    shmdir = None
+    if shmthreshold is not None and SHMDIR is not None:
+        shmdir = tempfile.mkdtemp(prefix='parallel_apply-', dir=SHMDIR)
+    errors = []
 
-    # start pool workers
-    pool = []
-    for i in xrange(n_jobs):
-        p = Process(target=_do_work_off_queue,
-                    args=(lock, in_q, func, out_q, sep))
-        p.start()
-        pool.append(p)
+    try:
+        # start pool workers
+        pool = []
+        for i in xrange(n_jobs):
+            p = Process(target=_do_work_off_queue,
+                        args=(in_q, func, out_q, sep, shmdir, shmthreshold))
+            p.start()
+            pool.append(p)
+
+        # start output worker
+        out_t = threading.Thread(target=_write_to_output,
+                                 args=(out_q, out_stream, n_jobs, errors))
+        out_t.daemon = True
+        out_t.start()
+
+        # put data on input queue
+        iterator = iter(iterable)
+        while True:
+            batch = [_to_wire(x, shmdir, shmthreshold)
+                     for x in itertools.islice(iterator, batchsize)]
+            if not batch:
+                break
+            in_q.put(batch)
+        for _ in xrange(n_jobs):
+            in_q.put(None)
+
+        # finish job
+        for p in pool:
+            p.join()
+        out_t.join()
+    finally:
+        if shmdir is not None:
+            shutil.rmtree(shmdir, ignore_errors=True)
+    if errors:
+        raise RuntimeError('parallel_apply, func failed in a worker:\n' +
+                           errors[0])
+
+
+def _apply_chunk(func, chunk):
+    return [func(x) for x in chunk]
+
+
+def _apply_chunk_timed(func, chunk):
+    starttime = time.time()
+    return [func(x) for x in chunk], time.time() - starttime
+
+
+class ChunkSizer(object):
+    """
+    Picks chunk sizes for chunksize='auto', from the per item task time and
+    pickled size measured so far.
 
-    # start output worker
-    out_p = Process(target=_write_to_output,
-                    args=(out_q, out_stream, n_jobs))
-    out_p.start()
+    Parameters
+    ----------
+    n_jobs : Integer
+    total : Integer
+        Number of items, if known (len(iterable)); near the end of the input
+        chunks shrink so that every worker gets a share of the tail.
+    targetseconds : Float
+        Task duration aimed for: long enough to amortize the IPC per task.
+    maxbytes : Integer
+        Cap on a chunk's pickled size.
+    maxchunk : Integer
+        Cap on the number of items in a chunk.
+
+    Chunks start at one item and at most double from one to the next, so an
+    early fast item doesn't produce one huge chunk.
+    """
+    # Pickle every n-th chunk to estimate payload sizes.
+    samplechunks = 8
+    smoothing = 0.3
+
+    def __init__(self, n_jobs, total=None, targetseconds=0.25,
+                 maxbytes=4 * 1024 ** 2, maxchunk=10000):
+        self.n_jobs = n_jobs
+        self.total = total
+        self.targetseconds = targetseconds
+        self.maxbytes = maxbytes
+        self.maxchunk = maxchunk
+        self.itemseconds = None
+        self.itembytes = None
+        self.submitted = 0
+        self.chunks = 0
+        self.lastsize = 1
+
+    @staticmethod
+    def _smooth(current, value, weight):
+        if current is None:
+            return value
+        return (1 - weight) * current + weight * value
+
+    def next_size(self):
+        size = self.maxchunk
+        if self.itemseconds is None:
+            size = 1
+        elif self.itemseconds > 0:
+            size = int(self.targetseconds / self.itemseconds)
+        if self.itembytes:
+            size = min(size, int(self.maxbytes / self.itembytes))
+        size = min(size, 2 * self.lastsize, self.maxchunk)
+        if self.total is not None:
+            remaining = self.total - self.submitted
+            size = min(size, -(-remaining // (2 * self.n_jobs)))
+        self.lastsize = max(size, 1)
+        return self.lastsize
+
+    def submitting(self, chunk):
+        self.submitted += len(chunk)
+        self.chunks += 1
+        if chunk and self.chunks % self.samplechunks == 1:
+            nbytes = len(cPickle.dumps(chunk, 2)) / float(len(chunk))
+            self.itembytes = self._smooth(self.itembytes, nbytes,
+                                          self.smoothing)
+
+    def record(self, nitems, seconds):
+        if nitems:
+            self.itemseconds = self._smooth(self.itemseconds,
+                                            seconds / nitems, self.smoothing)
+
+
+def _chunk_sizer(chunksize, n_jobs, iterable):
+    if chunksize != 'auto':
+        return None
+    try:
+        total = len(iterable)
+    except TypeError:
+        total = None
+    return ChunkSizer(n_jobs, total=total)
 
-    # put data on input queue
-    iters = itertools.chain(iterable, (None,) * n_jobs)
-    for each in iters:
-        in_q.put(each)
 
-    # finish job
-    for p in pool:
-        p.join()
-    out_p.join()
+def _bounded_imap(pool, func, iterable, chunksize, ordered, maxinflight,
+                  closepool=False):
+    """
+    imap over a multiprocessing.Pool that reads the next chunk of iterable
+    only once one of the 'maxinflight' outstanding chunks has been consumed.
+    """
+    sizer = chunksize if isinstance(chunksize, ChunkSizer) else None
+    iterator = iter(iterable)
+    done = queue.Queue()
+    inflight = OrderedDict()
+    keys = itertools.count()
+
+    def submit():
+        size = chunksize if sizer is None else sizer.next_size()
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return False
+        key = next(keys)
+        if sizer is None:
+            apply_chunk = _apply_chunk
+        else:
+            sizer.submitting(chunk)
+            apply_chunk = _apply_chunk_timed
+        if ordered:
+            # Ordered mode waits on the results themselves, in order.
+            inflight[key] = pool.apply_async(apply_chunk, (func, chunk))
+        else:
+            inflight[key] = pool.apply_async(
+                apply_chunk, (func, chunk),
+                callback=lambda value, key=key: done.put(key))
+        return True
+
+    def next_done():
+        # Failed chunks never reach the callback, so check for them too.
+        while True:
+            try:
+                return done.get(timeout=0.1)
+            except queue.Empty:
+                for result in inflight.values():
+                    if result.ready() and not result.successful():
+                        result.get()
+
+    try:
+        while len(inflight) < maxinflight and submit():
+            pass
+        while inflight:
+            if ordered:
+                key, result = inflight.popitem(last=False)
+            else:
+                result = inflight.pop(next_done())
+            results = result.get(GOOGLE)
+            if sizer is not None:
+                results, seconds = results
+                sizer.record(len(results), seconds)
+            submit()
+            for x in results:
+                yield x
+    finally:
+        if closepool:
+            pool.close()
+
+
+def _run_initializers(initializers):
+    for func, args in initializers:
+        func(*args)
+
 
+class WorkerPool(object):
+    """
+    A long-lived multiprocessing.Pool that imap_easy and map_easy (and their
+    callers) can share, so that worker processes (and whatever they import
+    or connect to) are set up once rather than on every call.
+
+    Parameters
+    ----------
+    n_jobs : Integer
+        As for imap_easy; -1 uses all CPUs.
+    initializer : Function
+        Called with initargs in each worker process as it starts, e.g. to
+        create an S3 client or a DB connection pool. More hooks can be added
+        with add_initializer.
+    maxtasksperchild : Integer
+        Replace a worker after this many tasks (None: never).
 
-def imap_easy(func, iterable, n_jobs, chunksize, ordered=True):
+    The processes are started on first use, and again after shutdown or in
+    a forked child. shutdown waits for outstanding work, terminate doesn't.
+
+    Examples
+    --------
+    >>> with WorkerPool(4, initializer=warm_up) as pool:
+    ...     results = imap_easy(func, iterable, 4, 100, pool=pool)
+    """
+    def __init__(self, n_jobs=-1, initializer=None, initargs=(),
+                 maxtasksperchild=None):
+        self.n_jobs = _n_jobs_wrap(n_jobs)
+        self.maxtasksperchild = maxtasksperchild
+        self.initializers = []
+        if initializer is not None:
+            self.initializers.append((initializer, tuple(initargs)))
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def add_initializer(self, func, *args):
+        """
+        Adds a per-process hook, run by workers started from now on.
+        """
+        self.initializers.append((func, args))
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = Pool(self.n_jobs,
+                                  initializer=_run_initializers,
+                                  initargs=(list(self.initializers),),
+                                  maxtasksperchild=self.maxtasksperchild)
+                self._pid = os.getpid()
+            return self._pool
+
+    def imap(self, func, iterable, chunksize=1, ordered=True,
+             maxinflight=None):
+        _trypickle(func)
+        sizer = _chunk_sizer(chunksize, self.n_jobs, iterable)
+        if sizer is not None:
+            return _bounded_imap(self.pool, func, iterable, sizer, ordered,
+                                 maxinflight or 2 * self.n_jobs)
+        if maxinflight:
+            return _bounded_imap(self.pool, func, iterable, chunksize,
+                                 ordered, maxinflight)
+        if ordered:
+            return self.pool.imap(func, iterable, chunksize=chunksize)
+        return self.pool.imap_unordered(func, iterable, chunksize=chunksize)
+
+    def map(self, func, iterable, chunksize=None):
+        if chunksize == 'auto':
+            return list(self.imap(func, iterable, chunksize='auto'))
+        _trypickle(func)
+        return self.pool.map_async(func, iterable,
+                                   chunksize=chunksize).get(GOOGLE)
+
+    def apply_async(self, func, args=(), kwds={}, callback=None):
+        return self.pool.apply_async(func, args, kwds, callback)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None and self._pid == os.getpid():
+            if wait:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+
+    def terminate(self):
+        self.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
+
+
+_DEFAULTPOOL = None
+_DEFAULTPOOLLOCK = threading.Lock()
+
+
+def default_pool(n_jobs=-1, initializer=None, initargs=()):
+    """
+    Returns the module's shared WorkerPool, creating it on first use (later
+    calls' arguments are ignored while it exists). It is shut down at exit,
+    or explicitly with shutdown_default_pool.
+    """
+    global _DEFAULTPOOL
+    with _DEFAULTPOOLLOCK:
+        if _DEFAULTPOOL is None:
+            _DEFAULTPOOL = WorkerPool(n_jobs, initializer=initializer,
+                                      initargs=initargs)
+        return _DEFAULTPOOL
+
+
+def shutdown_default_pool(wait=True):
+    global _DEFAULTPOOL
+    with _DEFAULTPOOLLOCK:
+        pool, _DEFAULTPOOL = _DEFAULTPOOL, None
+    if pool is not None:
+        pool.shutdown(wait=wait)
+
+
+atexit.register(shutdown_default_pool, wait=False)
+
+
+def _resolve_pool(pool):
+    if pool is True:
+        return default_pool()
+    return pool
+
+
+def imap_easy(func, iterable, n_jobs, chunksize, ordered=True, pool=None,
+              maxinflight=None):
     """
     Returns a parallel iterator of func over iterable.
     Worker processes return one "chunk" of data at a time, and the iterator
@@ -135,14 +513,25 @@ def imap_easy(func, iterable, n_jobs, chunksize, ordered=True):
         If 1 is given, no parallel computing code is used at all, which is
         useful for debugging. For n_jobs below -1, (n_cpus + 1 + n_jobs) are
         used. Thus for n_jobs = -2, all CPUs but one are used.
-    chunksize : Integer
+    chunksize : Integer or 'auto'
         Jobs/results will be sent between master/slave processes in chunks of
         size chunksize.  If chunksize is too small, communication overhead
         slows things down.  If chunksize is too large, one process ends up
         doing too much work (and large results will up in memory).
+        'auto' sizes chunks as the run goes, from the measured task time and
+        payload size, see ChunkSizer. It implies maxinflight (default
+        2 * n_jobs).
     ordered : Boolean
         If True, results are dished out in the order corresponding to iterable.
         If False, results are dished out in whatever order workers return them.
+    pool : WorkerPool
+        Run on this long-lived pool (True for default_pool()) instead of a
+        pool created for this call; n_jobs is then the pool's.
+    maxinflight : Integer
+        If given, at most this many chunks are submitted but not yet
+        consumed: iterable only advances as results are consumed, instead of
+        being read into the task queue as fast as possible, so memory stays
+        flat for long (or endless) inputs.
     Examples
     --------
     >>> from functools import partial
@@ -158,6 +547,11 @@ def imap_easy(func, iterable, n_jobs, chunksize, ordered=True):
     6
     12
     """
+    pool = _resolve_pool(pool)
+    if pool is not None:
+        return pool.imap(func, iterable, chunksize=chunksize, ordered=ordered,
+                         maxinflight=maxinflight)
+
     n_jobs = _n_jobs_wrap(n_jobs)
 
     if n_jobs == 1:
@@ -165,16 +559,25 @@ def imap_easy(func, iterable, n_jobs, chunksize, ordered=True):
     else:
         _trypickle(func)
         pool = Pool(n_jobs)
+        sizer = _chunk_sizer(chunksize, n_jobs, iterable)
+        if sizer is not None:
+            return _bounded_imap(pool, func, iterable, sizer, ordered,
+                                 maxinflight or 2 * n_jobs, closepool=True)
+        if maxinflight:
+            return _bounded_imap(pool, func, iterable, chunksize, ordered,
+                                 maxinflight, closepool=True)
         if ordered:
             results_iter = pool.imap(func, iterable, chunksize=chunksize)
         else:
             results_iter = pool.imap_unordered(
                 func, iterable, chunksize=chunksize)
+        # Workers exit once the submitted work is done.
+        pool.close()
 
     return results_iter
 
 
-def map_easy(func, iterable, n_jobs):
+def map_easy(func, iterable, n_jobs, pool=None, chunksize=None):
     """
     Returns a parallel map of func over iterable.
     Returns all results at once, so if results are big memory issues may arise
@@ -190,6 +593,10 @@ def map_easy(func, iterable, n_jobs):
         If 1 is given, no parallel computing code is used at all, which is
         useful for debugging. For n_jobs below -1, (n_cpus + 1 + n_jobs) are
         used. Thus for n_jobs = -2, all CPUs but one are used.
+    pool : WorkerPool
+        As for imap_easy.
+    chunksize : Integer or 'auto'
+        As for imap_easy, None lets Pool.map pick.
     Examples
     --------
     >>> from functools import partial
@@ -201,17 +608,28 @@ def map_easy(func, iterable, n_jobs):
     >>> map_easy(func, some_numbers)
     [0, 6, 12, 18, 24]
     """
+    pool = _resolve_pool(pool)
+    if pool is not None:
+        return pool.map(func, iterable, chunksize=chunksize)
+
     n_jobs = _n_jobs_wrap(n_jobs)
 
     if n_jobs == 1:
         return map(func, iterable)
+    elif chunksize == 'auto':
+        return list(imap_easy(func, iterable, n_jobs, 'auto'))
     else:
         _trypickle(func)
         pool = Pool(n_jobs)
-        return pool.map_async(func, iterable).get(GOOGLE)
+        try:
+            return pool.map_async(func, iterable,
+                                  chunksize=chunksize).get(GOOGLE)
+        finally:
+            pool.close()
 
 
-def map_easy_padded_blocks(func, iterable, n_jobs, pad, blocksize=None):
+def map_easy_padded_blocks(func, iterable, n_jobs, pad, blocksize=None,
+                           pool=None, shared=False, out=None):
     """
     Returns a parallel map of func over iterable, computed by splitting
     iterable into padded blocks, then piecing the result together.
@@ -231,10 +649,18 @@ def map_easy_padded_blocks(func, iterable, n_jobs, pad, blocksize=None):
         Each block is processed with pad extra on each side.
     blocksize : Nonnegative Integer
         If None, use 100 * pad
+    pool : WorkerPool
+        As for imap_easy.
+    shared : Boolean
+        If True, iterable must be a 1-d NumPy array, which is processed in
+        shared memory (see _map_padded_blocks_shared) and the result is an
+        array.
+    out : numpy.memmap
+        With shared, the array to write the result into.
     Returns
     -------
     result : List
-        Equivalent to list(func(iterable))
+        Equivalent to list(func(iterable)), an array with shared
     Examples
     --------
     >>> numbers = [0, 0, 2, -1, 4, 2, 6, 7, 6, 9]
@@ -247,6 +673,15 @@ def map_easy_padded_blocks(func, iterable, n_jobs, pad, blocksize=None):
     >>> result == benchmark
     True
     """
+    if shared:
+        if (numpy is None or not isinstance(iterable, numpy.ndarray) or
+                iterable.ndim != 1):
+            raise ValueError('shared needs a 1-d NumPy array')
+        return _map_padded_blocks_shared(func, iterable, n_jobs, pad,
+                                         blocksize=blocksize, pool=pool,
+                                         out=out)
+    elif out is not None:
+        raise ValueError('out needs shared=True')
     mylist = list(iterable)
 
     # We will pad each side of the blocks with this to avoid edge effects.
@@ -262,7 +697,7 @@ def map_easy_padded_blocks(func, iterable, n_jobs, pad, blocksize=None):
     block_iter = (mylist[start: end] for start, end in block_idx)
 
     # Process each block
-    processed_blocks = map_easy(func, block_iter, n_jobs)
+    processed_blocks = map_easy(func, block_iter, n_jobs, pool=pool)
 
     result = []
     for block, (leftpad, rightpad) in zip(processed_blocks, pads_used):
@@ -271,6 +706,96 @@ def map_easy_padded_blocks(func, iterable, n_jobs, pad, blocksize=None):
     return result
 
 
+def _memmap_file(array):
+    """
+    Returns the file backing array if it is a whole numpy.memmap, else None.
+    """
+    if (isinstance(array, numpy.memmap) and array.filename is not None and
+            array.offset == 0 and array.flags['C_CONTIGUOUS'] and
+            os.path.getsize(array.filename) == array.nbytes):
+        return array.filename
+    return None
+
+
+def _padded_block_worker(task, func, inpath, indtype, outpath, outdtype, n):
+    """
+    Runs func on one padded block, reading the input from and writing the
+    result to the shared memory maps; only indices travel between processes.
+    """
+    (start, end), (leftpad, rightpad) = task
+    inarray = numpy.memmap(inpath, dtype=indtype, mode='r', shape=(n,))
+    outarray = numpy.memmap(outpath, dtype=outdtype, mode='r+', shape=(n,))
+    block = numpy.asarray(func(inarray[start:end]))
+    outarray[start + leftpad:end - rightpad] = block[leftpad:len(block) - rightpad]
+    outarray.flush()
+    del inarray, outarray
+
+
+def _map_padded_blocks_shared(func, array, n_jobs, pad, blocksize=None,
+                              pool=None, out=None):
+    """
+    map_easy_padded_blocks for a 1-d NumPy array, without pickling blocks.
+
+    The input and the output live in memory mapped files (in /dev/shm when
+    available, so in shared memory), which workers map rather than receive:
+    each task is just a block's (start, end) and pads, and results are
+    written in place. Memory doesn't grow with the number of workers and the
+    data is never turned into a list. An input that already is a numpy.memmap
+    over a whole file is used without a copy.
+
+    func takes and returns 1-d arrays of the same length; the dtype of the
+    output is that of func's result on the first block (computed here).
+    out - optional numpy.memmap (over a whole file) receiving the result,
+          which is then returned; otherwise the result is returned as a
+          regular array and the temporary files are removed.
+    """
+    n = len(array)
+    max_blocksize = n - pad - 1
+    if blocksize is None:
+        blocksize = min(max_blocksize, 100 * pad)
+    assert pad + blocksize < n
+    block_idx, pads_used = _get_split_idx(n, blocksize, pad=pad)
+    tasks = zip(block_idx, pads_used)
+
+    workdir = tempfile.mkdtemp(prefix='padded_blocks-', dir=SHMDIR)
+    try:
+        inpath = _memmap_file(array)
+        if inpath is None:
+            inpath = os.path.join(workdir, 'in')
+            inarray = numpy.memmap(inpath, dtype=array.dtype, mode='w+',
+                                   shape=(n,))
+            inarray[:] = array
+            inarray.flush()
+            del inarray
+
+        # The first block tells the output's dtype.
+        (start, end), (leftpad, rightpad) = tasks[0]
+        first = numpy.asarray(func(array[start:end]))
+        if out is not None:
+            outpath = _memmap_file(out)
+            if outpath is None or len(out) != n:
+                raise ValueError('out should be a numpy.memmap of len(array)')
+            outdtype = out.dtype
+            outarray = out
+        else:
+            outpath = os.path.join(workdir, 'out')
+            outdtype = first.dtype
+            outarray = numpy.memmap(outpath, dtype=outdtype, mode='w+',
+                                    shape=(n,))
+        outarray[start + leftpad:end - rightpad] = first[leftpad:len(first) - rightpad]
+        outarray.flush()
+
+        worker = partial(_padded_block_worker, func=func, inpath=inpath,
+                         indtype=array.dtype, outpath=outpath,
+                         outdtype=outdtype, n=n)
+        map_easy(worker, tasks[1:], n_jobs, pool=pool)
+        if out is not None:
+            return out
+        return numpy.array(outarray)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
 def _get_split_idx(N, blocksize, pad=0):
     """
     Returns a list of indexes dividing an array into blocks of size blocksize
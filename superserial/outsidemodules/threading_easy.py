@@ -17,6 +17,10 @@ Functions to assist in multithreaded processing with Python 2.7.
 """
 import sys
 import threading
+from itertools import islice
+
+from six.moves import queue
+from six import reraise
 
 
 class LockIterateApply(threading.Thread):
@@ -132,3 +136,115 @@ def threading_easy(func, iterable, n_threads, sep='\n', out_stream=sys.stdout):
 
         for t in threads:
             t.join()
+
+
+_DONE = object()
+
+
+def _chunked(iterable, chunksize):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+def threading_imap(func, iterable, n_threads, ordered=True, chunksize=1,
+                   maxinflight=None):
+    """
+    Like itertools.imap, but func runs on a pool of threads; results are
+    yielded to the caller instead of written to a stream.
+
+    Parameters
+    ----------
+    func : function of one variable
+    iterable : iterable which yields function argument
+    n_threads : int
+        if None or <= 1, func is applied on the calling thread
+    ordered : bool
+        if True results are yielded in input order, else as they complete
+    chunksize : int
+        number of arguments handed to a thread at once
+    maxinflight : int
+        max number of chunks read from iterable but not yet yielded
+        (back-pressure on iterable), default 2 * n_threads
+
+    Returns
+    -------
+    generator of func's results
+
+    Notes: a single feeder thread reads iterable, so the threads never
+    contend for it. An exception raised by func (or by iterable) is re-raised
+    in the caller, with its traceback, and the remaining work is abandoned.
+    """
+    if n_threads is None or n_threads <= 1:
+        for each in iterable:
+            yield func(each)
+        return
+    maxinflight = maxinflight or 2 * n_threads
+    tasks = queue.Queue()
+    results = queue.Queue()
+    slots = queue.Queue(maxsize=maxinflight)
+    stop = threading.Event()
+
+    def feed():
+        count = 0
+        try:
+            for chunk in _chunked(iterable, chunksize):
+                slots.put(None)
+                if stop.is_set():
+                    break
+                tasks.put((count, chunk))
+                count += 1
+        except Exception:
+            results.put((None, None, sys.exc_info()))
+        finally:
+            for _ in range(n_threads):
+                tasks.put(_DONE)
+            results.put((_DONE, count, None))
+
+    def work():
+        for index, chunk in iter(tasks.get, _DONE):
+            if stop.is_set():
+                continue
+            try:
+                results.put((index, [func(x) for x in chunk], None))
+            except Exception:
+                results.put((index, None, sys.exc_info()))
+
+    threads = [threading.Thread(target=feed)]
+    threads.extend(threading.Thread(target=work) for _ in range(n_threads))
+    for t in threads:
+        t.daemon = True
+        t.start()
+    total = None
+    done = 0
+    waiting = {}
+    try:
+        while total is None or done < total:
+            index, chunkresults, excinfo = results.get()
+            if excinfo is not None:
+                reraise(*excinfo)
+            if index is _DONE:
+                total = chunkresults
+                continue
+            if not ordered:
+                ready = [chunkresults]
+            else:
+                waiting[index] = chunkresults
+                ready = []
+                while done + len(ready) in waiting:
+                    ready.append(waiting.pop(done + len(ready)))
+            for chunkresults in ready:
+                done += 1
+                slots.get()
+                for result in chunkresults:
+                    yield result
+    finally:
+        stop.set()
+        # Unblock the feeder if it waits for a slot.
+        try:
+            slots.get_nowait()
+        except queue.Empty:
+            pass
@@ -10,33 +10,108 @@ from . import(__title__, __version__, __status__, __license__, __maintainer__,
 import logging
 LOG = logging.getLogger(__name__)
 
+import sys
 from functools import partial
-from itertools import chain, izip_longest
+from itertools import chain, izip_longest, islice
+from threading import Lock, BoundedSemaphore
+
+from concurrent.futures import(ThreadPoolExecutor, Future, wait,
+                               as_completed)
+from six import reraise
 
 from superserial.outsidemodules.parallel_easy import imap_easy
+from superserial.utils import BackgroundWorker
+
+
+def stash_many_fallback(stashobj):
+    """
+    Returns stashobj.stash_many, or for stash objects that only implement
+    stash, a function that stashes each datum of a list in turn.
+    """
+    try:
+        return stashobj.stash_many
+    except AttributeError:
+        stash = stashobj.stash
+
+        def stash_many(datumdicts):
+            for datumdict in datumdicts:
+                stash(datumdict)
+        return stash_many
+
+
+def _group_by_key(datumdicts, keystoignore):
+    """
+    Turns a list of datumdicts into a dict of per key lists of datums.
+    """
+    batches = {}
+    for datumdict in datumdicts:
+        for key, value in datumdict.items():
+            if key not in keystoignore:
+                try:
+                    batches[key].append(value)
+                except KeyError:
+                    batches[key] = [value]
+    return batches
+
+
+def _unstashed(datumdicts, stashobjdict, keystoignore):
+    """
+    Drops the parts of each datumdict that their stash object reports as
+    already stashed (see the 'manifest' option of the stashes), and the
+    datumdicts left with nothing to stash.
+    """
+    stashed = dict((k, v.is_stashed) for k, v in stashobjdict.items()
+                   if callable(getattr(v, 'is_stashed', None)))
+    skipped = 0
+    for datumdict in datumdicts:
+        remaining = dict((k, v) for k, v in datumdict.items()
+                         if k in keystoignore or
+                         k not in stashed or not stashed[k](v))
+        if set(remaining) - set(keystoignore):
+            yield remaining
+        else:
+            skipped += 1
+            if skipped % 1000 == 0:
+                LOG.info('DatumsSkipped:\t' + str(skipped))
+    LOG.info('DatumsSkipped:\t' + str(skipped))
 
 
 def _io_negotiator_make(stashobjdict, **xargs):
     if type(stashobjdict) != dict:
         raise ValueError('stashobjdict should be a dict')
+    stashmanydict = dict((k, stash_many_fallback(v))
+                         for k, v in stashobjdict.items())
 
     def io_negotiator_stash(datumtype, datum, **xargs):
         stashobjdict[datumtype].stash(datum, **xargs)
 
+    def io_negotiator_stash_many(batches):
+        for datumtype, datums in batches.items():
+            stashmanydict[datumtype](datums)
+
     def io_negotiator_close(**xargs):
+        excinfo = None
         for stashobjtype, stashobj in stashobjdict.items():
+            try:
+                stashobj.close(**xargs)
+            except Exception:
+                LOG.error(str(stashobjtype) + " failed to close.")
+                excinfo = excinfo or sys.exc_info()
             LOG.debug(str(stashobjtype) + " is now closed.")
-            stashobj.close(**xargs)
+        if excinfo is not None:
+            reraise(*excinfo)
 
-    return io_negotiator_stash, io_negotiator_close
+    return io_negotiator_stash, io_negotiator_stash_many, io_negotiator_close
 
 
 class EnMasseStash(object):
     def __init__(self, stashobjdict, keystoignore={'id'}, **xargs):
         # TODO (steven_c) consider handling the encrypt key through xargs.
-        io_neg_stash, io_neg_close = _io_negotiator_make(stashobjdict,
-                                                         **xargs)
+        (io_neg_stash,
+         io_neg_stash_many,
+         io_neg_close) = _io_negotiator_make(stashobjdict, **xargs)
         self.io_negotiator_stash = io_neg_stash
+        self.io_negotiator_stash_many = io_neg_stash_many
         self.io_negotiator_close = io_neg_close
         self.keystoignore = keystoignore
 
@@ -46,6 +121,14 @@ class EnMasseStash(object):
                 self.io_negotiator_stash(datumtype=key,
                                          datum=value)
 
+    def stash_many(self, datumdicts):
+        """
+        Groups the datumdicts into per key batches and hands each batch to
+        the stash_many of the matching stash object.
+        """
+        self.io_negotiator_stash_many(_group_by_key(datumdicts,
+                                                    self.keystoignore))
+
     def close(self):
         self.io_negotiator_close()
 
@@ -56,16 +139,32 @@ class EnMasseStash(object):
         self.close()
 
 
-def stash_en_masse(datumiter, stashobjdict,
+def _batches(iterable, batchsize):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batchsize))
+        if not batch:
+            return
+        yield batch
+
+
+def stash_en_masse(datumiter, stashobjdict, batchsize=100, resume=False,
                    **xargs):
     """
     stashobjdict - dict that holds the stashobjects.
                    the key will be used to guide the packets.
+    batchsize - number of datumdicts grouped into each stash_many call.
+    resume - if True, skip what the stash objects' manifests already hold.
     """
     # TODO (steven_c) consider handling the encrypt key through xargs.
     with EnMasseStash(stashobjdict, **xargs) as stashobj:
-        for i, datum in enumerate(datumiter):
-            stashobj.stash(datum)
+        if resume:
+            datumiter = _unstashed(datumiter, stashobjdict,
+                                   stashobj.keystoignore)
+        i = 0
+        for batch in _batches(datumiter, batchsize):
+            stashobj.stash_many(batch)
+            i += len(batch)
             LOG.info('\t'.join(['DocsIterd:', str(i)]))
 
 
@@ -92,12 +191,70 @@ def _sort_iterables(*iters, **xargs):
     return queue
 
 
+class QueuedStash(object):
+    """
+    Wraps a stash object so that its stash calls run on a dedicated writer
+    thread, fed by a queue holding at most 'queuedepth' items (a datum for
+    stash, a whole batch for stash_many).
+
+    stash only blocks once the queue is full, so a slow stash object applies
+    back-pressure to the producer without stalling its neighbours.
+    close drains the queue and then closes the wrapped stash object.
+    Errors raised by the wrapped stash object are re-raised on the next call
+    to stash or close.
+    """
+    def __init__(self, stashobj, queuedepth=100):
+        self.stashobj = stashobj
+        self.queuedepth = queuedepth
+        if callable(getattr(stashobj, 'is_stashed', None)):
+            self.is_stashed = stashobj.is_stashed
+        self.worker = BackgroundWorker(stash_many_fallback(stashobj),
+                                       queuedepth=queuedepth,
+                                       name='QueuedStash-' + type(stashobj).__name__)
+
+    def stash(self, datumdict):
+        self.worker.put([datumdict])
+
+    def stash_many(self, datumdicts):
+        self.worker.put(datumdicts)
+
+    def close(self):
+        LOG.debug('QueuedStash, close has been called')
+        try:
+            self.worker.close()
+        finally:
+            self.stashobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return 'QueuedStash(' + repr(self.stashobj) + ')'
+
+
 class Gula(object):
+    @classmethod
+    def queued(cls, queuedepth=100, **stash_objs):
+        """
+        Returns a Gula where every stash object gets its own QueuedStash,
+        i.e. its own bounded queue (of 'queuedepth' datums) and writer thread.
+        close drains all of the queues.
+        """
+        return cls(**dict((k, QueuedStash(v, queuedepth=queuedepth))
+                          for k, v in stash_objs.items()))
+
     def __init__(self, **stash_objs):
-        io_neg_stash, io_neg_close = _io_negotiator_make(stash_objs)
+        (io_neg_stash,
+         io_neg_stash_many,
+         io_neg_close) = _io_negotiator_make(stash_objs)
         self._io_negotiator_stash = io_neg_stash
+        self._io_negotiator_stash_many = io_neg_stash_many
         self._io_negotiator_close = io_neg_close
         self.keystoignore = {'id'}
+        self._stash_objs = stash_objs
         self._repr = 'Gula(' + repr(stash_objs) + ')'
 
         for k, v in stash_objs.items():
@@ -109,6 +266,14 @@ class Gula(object):
                 self._io_negotiator_stash(datumtype=k,
                                           datum=v)
 
+    def stash_many(self, datumdicts):
+        """
+        Groups the datumdicts into per key batches and hands each batch to
+        the stash_many of the matching stash object.
+        """
+        self._io_negotiator_stash_many(_group_by_key(datumdicts,
+                                                     self.keystoignore))
+
     @staticmethod
     def _sort_iterables(*iters, **xargs):
         try:
@@ -123,13 +288,24 @@ class Gula(object):
         return queue
 
     def consume(self, *datumiter, **xargs):
+        """
+        Stashes every datumdict of the datumiters.
+
+        swap - if True, alternate between the datumiters instead of chaining.
+        batchsize - number of datumdicts grouped into each stash_many call
+                    (default 100).
+        resume - if True, skip the parts of the datumdicts that the stash
+                 objects' manifests already hold, to pick an interrupted run
+                 back up.
+        """
         queue = self._sort_iterables(*datumiter, **xargs)
+        if xargs.get('resume'):
+            queue = _unstashed(queue, self._stash_objs, self.keystoignore)
+        batchsize = xargs.get('batchsize', 100)
         i = 0  # if datumiter is zero len
-        for i, datumdict in enumerate(queue):
-            self.stash(datumdict=datumdict)
-            if not i % 100:
-                LOG.info('DatumsIterd:\t' + str(i))
-        if len(datumiter):
+        for batch in _batches(queue, batchsize):
+            self.stash_many(datumdicts=batch)
+            i += len(batch)
             LOG.info('DatumsIterd:\t' + str(i))
 
     def close(self):
@@ -151,3 +327,160 @@ class Gula(object):
 
     def __unicode__(self):
         return unicode(str(self))
+
+
+# -----------------------------------------------------------------------------
+# Async
+class ExecutorStash(object):
+    """
+    Adapts a synchronous stash object (LocalFileStash, SQLStash, S3FileStash,
+    ...) to the future based protocol used by AsyncGula.
+
+    stashobj - the synchronous stash object to wrap.
+    workers - number of threads calling stashobj.stash. Leave at 1 for stash
+              objects that are not thread safe (SQLStash, S3FileStashPool).
+    executor - optional concurrent.futures executor to share between stashes.
+    """
+    def __init__(self, stashobj, workers=1, executor=None):
+        self.stashobj = stashobj
+        self._ownexecutor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=workers)
+        self.executor = executor
+        self._pending = set()
+        self._lock = Lock()
+
+    def _discard(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def stash_async(self, datumdict):
+        future = self.executor.submit(self.stashobj.stash, datumdict)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def _close(self):
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending)
+        self.stashobj.close()
+
+    def close_async(self):
+        future = self.executor.submit(self._close)
+        if self._ownexecutor:
+            self.executor.shutdown(wait=False)
+        return future
+
+    def __repr__(self):
+        return 'ExecutorStash(' + repr(self.stashobj) + ')'
+
+
+def _as_async_stash(stashobj, workers=1):
+    if hasattr(stashobj, 'stash_async'):
+        return stashobj
+    return ExecutorStash(stashobj, workers=workers)
+
+
+class AsyncGula(object):
+    """
+    Like Gula, but keeps up to 'maxinflight' stash calls running at once.
+
+    Stash objects that implement the async protocol:
+        stash_async(datumdict) -> concurrent.futures.Future
+        close_async() -> concurrent.futures.Future
+    are used as is, any other stash object is wrapped in an ExecutorStash
+    (using 'workers' threads) so that it runs off of the consuming thread.
+
+    consume accepts iterables of datumdicts or of futures that resolve to
+    datumdicts (e.g. the results of an executor), futures are dispatched in
+    the order they complete.
+
+    Errors raised by a stash object are re-raised on the next call to stash,
+    consume or close.
+    """
+    def __init__(self, maxinflight=64, workers=1, **stash_objs):
+        self._stash_objs = dict((k, _as_async_stash(v, workers=workers))
+                                for k, v in stash_objs.items())
+        self.keystoignore = {'id'}
+        self._maxinflight = maxinflight
+        self._inflight = BoundedSemaphore(maxinflight)
+        self._errors = []
+        self._repr = 'AsyncGula(' + repr(stash_objs) + ')'
+
+    def _done(self, future):
+        if future.exception() is not None:
+            self._errors.append(future.exception())
+        self._inflight.release()
+
+    def _drain(self):
+        for _ in xrange(self._maxinflight):
+            self._inflight.acquire()
+        for _ in xrange(self._maxinflight):
+            self._inflight.release()
+
+    def _raise_errors(self):
+        if self._errors:
+            raise self._errors.pop(0)
+
+    def stash(self, datumdict):
+        self._raise_errors()
+        for k, v in datumdict.items():
+            if k not in self.keystoignore:
+                self._inflight.acquire()
+                try:
+                    future = self._stash_objs[k].stash_async(v)
+                except:
+                    self._inflight.release()
+                    raise
+                future.add_done_callback(self._done)
+
+    @staticmethod
+    def _resolve(queue):
+        waiting = set()
+        for datumdict in queue:
+            if isinstance(datumdict, Future):
+                waiting.add(datumdict)
+                done, waiting = wait(waiting, timeout=0)
+                for future in done:
+                    yield future.result()
+            else:
+                yield datumdict
+        for future in as_completed(waiting):
+            yield future.result()
+
+    def consume(self, *datumiter, **xargs):
+        queue = self._resolve(Gula._sort_iterables(*datumiter, **xargs))
+        i = 0  # if datumiter is zero len
+        for i, datumdict in enumerate(queue):
+            self.stash(datumdict=datumdict)
+            if not i % 100:
+                LOG.info('DatumsIterd:\t' + str(i))
+        if len(datumiter):
+            LOG.info('DatumsIterd:\t' + str(i))
+
+    def close(self):
+        LOG.debug('AsyncGula has now closed')
+        self._drain()
+        closing = []
+        for stashobjtype, stashobj in self._stash_objs.items():
+            closing.append(stashobj.close_async())
+            LOG.debug(str(stashobjtype) + " is now closing.")
+        for future in closing:
+            if future is not None:
+                future.result()
+        self._raise_errors()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        LOG.debug('AsyncGula, exit has been called.')
+        self.close()
+
+    def __repr__(self):
+        return self._repr
+
+    def __str__(self):
+        return repr(self)
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Steven Cutting'
+__author_email__ = 'steven.e.cutting@linux.com'
+__created_on__ = '8/31/2015'
+__copyright__ = "superserial  Copyright (C) 2015  Steven Cutting"
+
+from . import(__title__, __version__, __status__, __license__, __maintainer__,
+              __email__)
+
+
+import logging
+LOG = logging.getLogger(__name__)
+
+import os
+import sqlite3
+from hashlib import md5
+from threading import Lock
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+INDEXDIR = os.getenv('SUPERSERIAL_INDEX_DIR',
+                     os.path.join(os.path.expanduser('~'), '.superserial'))
+
+
+# ------------------------------------------------------------------------------
+# Hashing
+
+if xxhash is not None:
+    _HASHNAME = 'xxh128' if hasattr(xxhash, 'xxh3_128') else 'xxh64'
+    _hasher = getattr(xxhash, 'xxh3_128', xxhash.xxh64)
+else:
+    _HASHNAME = 'md5'
+    _hasher = md5
+
+
+def content_hash(content):
+    """
+    Fast hash of a datum's content, xxhash if it is installed (the 'dedup'
+    extra), md5 if not.
+    The name of the hash and the content's length are part of the result,
+    so indexes built with different hashes never match each other.
+    """
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return ':'.join([_HASHNAME, _hasher(content).hexdigest(),
+                     str(len(content))])
+
+
+# ------------------------------------------------------------------------------
+# Dedup
+
+def default_index_path(parenturi, name='dedup', indexdir=None):
+    """
+    Where the index for a stash writing to 'parenturi' lives by default,
+    in 'indexdir' if given, INDEXDIR if not.
+    """
+    return os.path.join(indexdir or INDEXDIR,
+                        '-'.join([name, md5(parenturi).hexdigest()]) +
+                        '.sqlite')
+
+
+class DedupIndex(object):
+    """
+    Persistent (sqlite) index of the content a stash has already stored,
+    so duplicate content is stored once.
+
+    claim(pointer, content) records that 'pointer' holds 'content' and
+    returns False when that content is already stored (under 'pointer' or
+    any other pointer), i.e. when the write can be skipped.
+    resolve(pointer) gives the pointer the content was actually stored under.
+    When a pointer that other pointers were deduplicated onto is given new
+    content, its old content is moved to one of those pointers: claim
+    records the move and pop_relocations() hands the (from, to) pairs to
+    the stash, which copies the stored object before overwriting it.
+
+    path - the sqlite file, created if needed.
+    commitevery - claims between commits; commits only happen while no
+                  claimed write is in flight.
+
+    A claim that returns True is in flight until the stash reports its write
+    with stored(pointer), or its failure with forget(pointer), which undoes
+    the claim (and the claims of duplicates of it, which weren't stored
+    either). So the index never lists content that wasn't stored, and a
+    failed write costs only its own claims.
+    """
+    def __init__(self, path, commitevery=1000):
+        self.path = path
+        self.commitevery = commitevery
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS content '
+                          '(hash TEXT PRIMARY KEY, pointer TEXT NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS pointers '
+                          '(pointer TEXT PRIMARY KEY, hash TEXT NOT NULL)')
+        self.conn.commit()
+        self.lock = Lock()
+        self.written = 0
+        self.skipped = 0
+        self.relocations = []
+        self.inflight = {}
+        self.claims = 0
+        self.uncommitted = 0
+
+    def _stored_under(self, contenthash):
+        row = self.conn.execute('SELECT pointer FROM content WHERE hash = ?',
+                                (contenthash,)).fetchone()
+        return None if row is None else row[0]
+
+    def _overwrite(self, pointer, oldhash):
+        if self._stored_under(oldhash) != pointer:
+            return
+        other = self.conn.execute('SELECT pointer FROM pointers '
+                                  'WHERE hash = ? AND pointer != ? LIMIT 1',
+                                  (oldhash, pointer)).fetchone()
+        if other is None:
+            # Nothing else refers to the old content, it goes with the write.
+            self.conn.execute('DELETE FROM content WHERE hash = ?', (oldhash,))
+        else:
+            self.conn.execute('UPDATE content SET pointer = ? WHERE hash = ?',
+                              (other[0], oldhash))
+            self.relocations.append((pointer, other[0]))
+
+    def _maybe_commit(self):
+        if self.uncommitted >= self.commitevery and not self.inflight:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def claim(self, pointer, content):
+        contenthash = content_hash(content)
+        with self.lock:
+            self.claims += 1
+            self.uncommitted += 1
+            row = self.conn.execute('SELECT hash FROM pointers WHERE pointer = ?',
+                                    (pointer,)).fetchone()
+            if row is not None and row[0] != contenthash:
+                self._overwrite(pointer, row[0])
+            self.conn.execute('INSERT OR REPLACE INTO pointers VALUES (?, ?)',
+                              (pointer, contenthash))
+            if self._stored_under(contenthash) is not None:
+                self.skipped += 1
+                self._maybe_commit()
+                return False
+            self.conn.execute('INSERT INTO content VALUES (?, ?)',
+                              (contenthash, pointer))
+            self.written += 1
+            self.inflight[pointer] = self.claims
+            return True
+
+    def mark(self):
+        """
+        A marker for forget_since.
+        """
+        with self.lock:
+            return self.claims
+
+    def stored(self, pointer):
+        with self.lock:
+            if self.inflight.pop(pointer, None) is not None:
+                self._maybe_commit()
+
+    def forget(self, pointer):
+        with self.lock:
+            if self.inflight.pop(pointer, None) is None:
+                return
+            row = self.conn.execute('SELECT hash FROM pointers WHERE pointer = ?',
+                                    (pointer,)).fetchone()
+            if row is None:
+                return
+            self.conn.execute('DELETE FROM pointers WHERE pointer = ?',
+                              (pointer,))
+            self.written -= 1
+            if self._stored_under(row[0]) == pointer:
+                self.conn.execute('DELETE FROM content WHERE hash = ?',
+                                  (row[0],))
+                dropped = self.conn.execute('DELETE FROM pointers '
+                                            'WHERE hash = ?',
+                                            (row[0],)).rowcount
+                if dropped > 0:
+                    LOG.warning('Dedup: ' + str(dropped) + ' duplicates of ' +
+                                repr(pointer) + ' were not stored')
+            self.uncommitted += 1
+            self._maybe_commit()
+
+    def forget_since(self, mark):
+        """
+        Forgets the claims made after 'mark' whose writes are still in flight.
+        """
+        with self.lock:
+            pointers = [p for p, n in self.inflight.items() if n > mark]
+        for pointer in pointers:
+            self.forget(pointer)
+
+    def resolve(self, pointer):
+        with self.lock:
+            row = self.conn.execute('SELECT content.pointer FROM pointers '
+                                    'JOIN content USING (hash) '
+                                    'WHERE pointers.pointer = ?',
+                                    (pointer,)).fetchone()
+        return pointer if row is None else row[0]
+
+    def pop_relocations(self):
+        with self.lock:
+            relocations, self.relocations = self.relocations, []
+        return relocations
+
+    def stats(self):
+        return {'written': self.written, 'skipped': self.skipped}
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        # Writes that never reported back weren't stored.
+        self.forget_since(0)
+        self.commit()
+        self.conn.close()
+
+
+def dedup_index(dedup, parenturi):
+    """
+    The DedupIndex for a stash's 'dedup' option: None/False for none,
+    True for the default index of 'parenturi', a path, or an index object.
+    """
+    if dedup is None or dedup is False:
+        return None
+    elif dedup is True:
+        return DedupIndex(default_index_path(parenturi))
+    elif isinstance(dedup, basestring):
+        return DedupIndex(dedup)
+    return dedup
+
+
+# ------------------------------------------------------------------------------
+# Manifests
+
+class Manifest(object):
+    """
+    Persistent (sqlite) record of the pointers a stash has stored, so that an
+    interrupted run can be resumed, see Gula.consume(resume=True).
+
+    path - the sqlite file, created if needed.
+    commitevery - pointers recorded between commits; what was recorded
+                  before the last commit survives a crash.
+
+    Stashes add pointers only once they are written, so a pointer in the
+    manifest is always stored.
+    """
+    def __init__(self, path, commitevery=1000):
+        self.path = path
+        self.commitevery = commitevery
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS stashed '
+                          '(pointer TEXT PRIMARY KEY)')
+        self.conn.commit()
+        self.lock = Lock()
+        self.uncommitted = 0
+
+    def add_many(self, pointers):
+        with self.lock:
+            cursor = self.conn.executemany('INSERT OR IGNORE INTO stashed '
+                                           'VALUES (?)',
+                                           ((p,) for p in pointers))
+            self.uncommitted += max(cursor.rowcount, 0)
+            if self.uncommitted >= self.commitevery:
+                self.conn.commit()
+                self.uncommitted = 0
+
+    def add(self, pointer):
+        self.add_many([pointer])
+
+    def __contains__(self, pointer):
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM stashed WHERE pointer = ?',
+                                     (pointer,)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM stashed').fetchone()[0]
+
+    def seed_s3(self, client, bucket, prefix=''):
+        """
+        Records every key under 'prefix' in 'bucket', listing them with
+        list_objects_v2 (1000 keys per request) rather than a HEAD per key.
+        Returns the number of keys listed.
+        """
+        count = 0
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            keys = [obj['Key'] for obj in page.get('Contents', [])]
+            self.add_many(keys)
+            count += len(keys)
+        self.commit()
+        LOG.info('Manifest seeded with:\t' + str(count) + ' keys')
+        return count
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
+def manifest_index(manifest, parenturi):
+    """
+    The Manifest for a stash's 'manifest' option, resolved like dedup_index.
+    """
+    if manifest is None or manifest is False:
+        return None
+    elif manifest is True:
+        return Manifest(default_index_path(parenturi, name='manifest'))
+    elif isinstance(manifest, basestring):
+        return Manifest(manifest)
+    return manifest
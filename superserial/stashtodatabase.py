@@ -10,32 +10,262 @@ from . import(__title__, __version__, __status__, __license__, __maintainer__,
 import logging
 LOG = logging.getLogger(__name__)
 
+import sys
+import time
+import threading
 from os import getenv
+from io import BytesIO
+import datetime
+import json
+from collections import OrderedDict
 
 import dataset
 from sqlalchemy.exc import NoSuchTableError
+from sqlalchemy.dialects import postgresql
+from six.moves.urllib.parse import urlsplit
+from six import reraise
 
-from superserial.utils import get_default_data_key
+from superserial.utils import(get_default_data_key,
+                              ENGINES,
+                              BackgroundWorker)
+from superserial.stashindex import manifest_index
+
+
+POSTGRESSCHEMES = {'postgres', 'postgresql'}
+
+
+UPSERTDIALECTS = {'postgres', 'postgresql', 'sqlite'}
+
+# Max bind parameters per statement.
+MAXPARAMS = {'postgresql': 32767,
+             'sqlite': 999,
+             }
+
+
+def uri_dialect(uri):
+    return urlsplit(uri).scheme.split('+')[0]
+
+
+def is_postgres_uri(uri):
+    return uri_dialect(uri) in POSTGRESSCHEMES
+
+
+def _csv_field(value):
+    """
+    Encodes a value as a COPY csv field. None is left unquoted (read as NULL
+    by COPY) everything else is quoted, so '' stays an empty string.
+    """
+    if value is None:
+        return b''
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif isinstance(value, (datetime.datetime, datetime.date)):
+        value = value.isoformat()
+    elif isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    elif isinstance(value, float):
+        # str rounds to 12 significant digits, repr round-trips.
+        value = repr(value)
+    elif not isinstance(value, bytes):
+        value = str(value)
+    return b'"' + value.replace(b'"', b'""') + b'"'
+
+
+def write_copy_csv(rows, columns, buff):
+    """
+    Writes rows (dicts) to buff in the csv layout expected by
+    COPY ... FROM STDIN WITH (FORMAT csv). Missing keys are written as NULL.
+    """
+    write = buff.write
+    for row in rows:
+        write(b','.join([_csv_field(row.get(column)) for column in columns]))
+        write(b'\n')
+
+
+def row_nbytes(row):
+    """
+    Cheap estimate of the size of a row, strings count their length and
+    anything else 8 bytes.
+    """
+    nbytes = 0
+    for value in row.values():
+        if isinstance(value, basestring):
+            nbytes += len(value)
+        else:
+            nbytes += 8
+    return nbytes
+
+
+class FlushPolicy(object):
+    """
+    Decides when a SQLStash flushes its stack and keeps the flush stats.
+
+    maxrows - flush once the stack holds this many rows.
+    maxbytes - flush once the stack holds this many bytes (see row_nbytes).
+    maxlinger - flush once the oldest row has waited this many seconds.
+    autotune - if True, maxrows is adjusted after every flush so that a
+               flush takes about 'targetlatency' seconds, based on a moving
+               average of the insert latency per row. maxrows stays within
+               [minrows, maxrowslimit].
+
+    stats holds the flush, row and byte counts, the flush latencies and how
+    often each trigger ('rows', 'bytes', 'linger', 'close') fired.
+    """
+    def __init__(self, maxrows=20, maxbytes=None, maxlinger=None,
+                 autotune=False, targetlatency=1.0, minrows=1,
+                 maxrowslimit=100000, smoothing=0.3):
+        self.maxrows = maxrows
+        self.maxbytes = maxbytes
+        self.maxlinger = maxlinger
+        self.autotune = autotune
+        self.targetlatency = targetlatency
+        self.minrows = minrows
+        self.maxrowslimit = maxrowslimit
+        self.smoothing = smoothing
+        self.rowlatency = None
+        self._lock = threading.Lock()
+        self.stats = {'flushes': 0,
+                      'rows': 0,
+                      'bytes': 0,
+                      'seconds': 0.0,
+                      'lastlatency': None,
+                      'maxlatency': 0.0,
+                      'triggers': {},
+                      }
+
+    def due(self, nrows, nbytes, age):
+        """
+        Returns why the stack should be flushed, or None.
+        """
+        if nrows >= self.maxrows:
+            return 'rows'
+        elif self.maxbytes is not None and nbytes >= self.maxbytes:
+            return 'bytes'
+        elif self.maxlinger is not None and nrows and age >= self.maxlinger:
+            return 'linger'
+        return None
+
+    def triggered(self, trigger):
+        with self._lock:
+            triggers = self.stats['triggers']
+            triggers[trigger] = triggers.get(trigger, 0) + 1
+
+    def record(self, nrows, nbytes, seconds):
+        with self._lock:
+            stats = self.stats
+            stats['flushes'] += 1
+            stats['rows'] += nrows
+            stats['bytes'] += nbytes
+            stats['seconds'] += seconds
+            stats['lastlatency'] = seconds
+            stats['maxlatency'] = max(stats['maxlatency'], seconds)
+            if not nrows:
+                return
+            perrow = seconds / nrows
+            if self.rowlatency is None:
+                self.rowlatency = perrow
+            else:
+                self.rowlatency += self.smoothing * (perrow - self.rowlatency)
+            if self.autotune and self.rowlatency > 0:
+                self.maxrows = int(min(self.maxrowslimit,
+                                       max(self.minrows,
+                                           self.targetlatency / self.rowlatency)))
+
+    def summary(self):
+        """
+        Copy of stats with averages and the current maxrows.
+        """
+        with self._lock:
+            summary = dict(self.stats, triggers=dict(self.stats['triggers']))
+        flushes = summary['flushes'] or 1
+        summary['meanlatency'] = summary['seconds'] / flushes
+        summary['meanrows'] = summary['rows'] / float(flushes)
+        summary['meanbytes'] = summary['bytes'] / float(flushes)
+        summary['maxrows'] = self.maxrows
+        return summary
 
 
 class SQLStash(object):
+    """
+    Used for streaming rows (datumdicts) into a table.
+
+    uri - the database uri.
+    table - the table the rows go into, created (with a String(36) 'id'
+            primary key) if it doesn't exist.
+    chuncksize - the number of rows to stack up before flushing them.
+    maxbytes, maxlinger, autotune, targetlatency - the rest of the flush
+        policy, see FlushPolicy. With maxlinger a timer thread flushes stacks
+        that have waited too long even if no more rows arrive.
+        Flush stats are available from flush_stats().
+    copy - if True, flush through COPY ... FROM STDIN (csv), the rows being
+           encoded into a reusable buffer. Only possible for postgresql,
+           which is also the default; other dialects use insert_many.
+    upsert - if True, rows replace existing rows with the same 'id', so that
+             re-running an ingest is idempotent. Each flush is sent as
+             multi-row INSERT ... ON CONFLICT (id) DO UPDATE statements
+             (INSERT OR REPLACE on sqlite). Rows missing a column set it to
+             NULL and only the last row for an id, within a flush, is kept.
+             Can't be combined with copy; postgresql and sqlite only.
+    background - if True, full stacks are inserted and committed by a
+                 dedicated writer thread while the next stack fills up.
+                 At most 'maxinflight' stacks wait for the writer before
+                 stash blocks. Writer errors are re-raised by the next call
+                 to stash or close.
+
+    manifest - record the 'id' of every committed row in a Manifest: True
+               for the default manifest of uri and table, or its path.
+               is_stashed(row) then tells whether a row was already
+               committed, which is how Gula.consume(resume=True) skips it.
+
+    Connections come from the process wide pool in utils.ENGINES (except for
+    sqlite), configure it with ENGINES.configure(poolsize=..., preping=...).
+    """
     def __init__(self, uri=getenv('DATABASE_URL'),
                  table=getenv('STASH_TABLE_NAME'),
                  chuncksize=20,
                  encryptkey=getenv('DAS_ENCRYPT_KEY', get_default_data_key()),
                  # TODO (steven_c) consider removeing
                  index=False, indexcolumns=None,
-                 **xargs):
+                 copy=None, upsert=False,
+                 background=False, maxinflight=2,
+                 maxbytes=None, maxlinger=None,
+                 autotune=False, targetlatency=1.0,
+                 manifest=None, **xargs):
         self.uri = uri
         self.chuncksize = chuncksize
+        self.policy = FlushPolicy(maxrows=chuncksize,
+                                  maxbytes=maxbytes,
+                                  maxlinger=maxlinger,
+                                  autotune=autotune,
+                                  targetlatency=targetlatency)
+        if upsert and uri_dialect(uri) not in UPSERTDIALECTS:
+            raise ValueError('upsert is only supported for ' +
+                             ', '.join(sorted(UPSERTDIALECTS)) + ' uris')
+        if copy is None:
+            copy = is_postgres_uri(uri) and not upsert
+        elif copy and not is_postgres_uri(uri):
+            raise ValueError('copy is only supported for postgresql uris')
+        elif copy and upsert:
+            raise ValueError('copy and upsert can not be combined')
+        self.copy = copy
+        self.upsert = upsert
+        self.background = background
+        self._copybuffer = BytesIO()
+        self.manifest = manifest_index(manifest, '/'.join([str(uri),
+                                                           str(table)]))
         self.table = table
         self.index = index
         self.indexcolumns = indexcolumns
-        self.conn = dataset.connect(uri, reflect_metadata=False,
-                                    engine_kwargs={'pool_recycle': 3600,
-                                                   'convert_unicode': True,
-                                                   'encoding': 'utf-8',
-                                                   })
+        if ENGINES.is_pooled(uri):
+            self.conn = ENGINES.database(uri)
+        else:
+            engine_kwargs = {'convert_unicode': True,
+                             'encoding': 'utf-8',
+                             'pool_recycle': 3600,
+                             'connect_args': {'check_same_thread': False},
+                             }
+            self.conn = dataset.connect(uri, reflect_metadata=False,
+                                        engine_kwargs=engine_kwargs)
         self.conn.begin()
         try:
             self.tbl = self.conn.load_table(self.table)
@@ -50,26 +280,204 @@ class SQLStash(object):
                 for ic in self.indexcolumns:
                     self.tbl.create_index(columns=ic)
         self.stack = []
+        self.stackbytes = 0
+        self.stackstart = None
+        self._lock = threading.RLock()
+        self._excinfo = None
+        # Every flush runs its own transaction, on whichever thread flushes
+        # (the caller's, an executor's, the writer's or the linger thread),
+        # so no transaction (nor dataset's lock) is held between calls.
+        self.conn.commit()
+        if background:
+            self.writer = BackgroundWorker(self._write_rows,
+                                           queuedepth=maxinflight,
+                                           name='SQLStash-' + str(table))
+        self._closed = threading.Event()
+        if maxlinger:
+            self._lingerer = threading.Thread(target=self._linger,
+                                              name='SQLStash-linger-' + str(table))
+            self._lingerer.daemon = True
+            self._lingerer.start()
+
+    def _columns_of(self, rows):
+        """
+        Returns the columns used by the rows (in order of appearance) and
+        makes sure each of them exists in the table.
+        """
+        columns = []
+        example = {}
+        for row in rows:
+            for column, value in row.items():
+                if column not in example:
+                    columns.append(column)
+                    example[column] = value
+                elif example[column] is None:
+                    example[column] = value
+        self.tbl._ensure_columns(example)
+        return columns
+
+    def copy_rows(self, rows):
+        """
+        Streams the rows into the table with COPY ... FROM STDIN.
+        """
+        columns = self._columns_of(rows)
+        buff = self._copybuffer
+        buff.seek(0)
+        buff.truncate()
+        write_copy_csv(rows, columns, buff)
+        buff.seek(0)
+        preparer = self.conn.engine.dialect.identifier_preparer
+        query = ''.join(['COPY ', preparer.format_table(self.tbl.table),
+                         ' (', ', '.join(preparer.quote(c) for c in columns),
+                         ") FROM STDIN WITH (FORMAT csv, ENCODING 'UTF8')"])
+        rawconn = self.conn.engine.raw_connection()
+        try:
+            cursor = rawconn.cursor()
+            cursor.copy_expert(query, buff)
+            cursor.close()
+            rawconn.commit()
+        except Exception:
+            rawconn.rollback()
+            raise
+        finally:
+            rawconn.close()
+
+    def _upsert_statement(self, columns):
+        table = self.tbl.table
+        if self.conn.engine.dialect.name == 'postgresql':
+            stmt = postgresql.insert(table)
+            updates = dict((c, stmt.excluded[c]) for c in columns if c != 'id')
+            if updates:
+                return stmt.on_conflict_do_update(index_elements=['id'],
+                                                  set_=updates)
+            return stmt.on_conflict_do_nothing(index_elements=['id'])
+        return table.insert().prefix_with('OR REPLACE')
+
+    def upsert_rows(self, rows):
+        """
+        Inserts or replaces (by 'id') the rows, with as few multi-row
+        statements as the dialect's bind parameter limit allows.
+        """
+        columns = self._columns_of(rows)
+        rows = OrderedDict((row['id'], row) for row in rows).values()
+        rows = [dict((c, row.get(c)) for c in columns) for row in rows]
+        stmt = self._upsert_statement(columns)
+        step = max(1, MAXPARAMS[self.conn.engine.dialect.name] // len(columns))
+        executable = self.conn.executable
+        for i in xrange(0, len(rows), step):
+            executable.execute(stmt.values(rows[i:i + step]))
 
-    def flush_the_stack(self, chunk_size=None):
+    def _insert_rows(self, rows, chunk_size):
+        if self.upsert:
+            self.upsert_rows(rows)
+        elif self.copy:
+            self.copy_rows(rows)
+        else:
+            self.tbl.insert_many(rows=rows,
+                                 chunk_size=chunk_size)
+
+    def _write_rows(self, stackinfo):
+        """
+        Inserts and commits a stack in one transaction, on the writer thread
+        in background mode.
+        """
+        rows, nbytes, chunk_size = stackinfo
+        starttime = time.time()
+        self.conn.begin()
+        try:
+            self._insert_rows(rows, chunk_size)
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        self.policy.record(len(rows), nbytes, time.time() - starttime)
+        self._committed(rows)
+
+    def _committed(self, rows):
+        if self.manifest is not None:
+            self.manifest.add_many(row['id'] for row in rows if 'id' in row)
+
+    def is_stashed(self, datumdict):
+        return (self.manifest is not None and 'id' in datumdict and
+                datumdict['id'] in self.manifest)
+
+    def flush_the_stack(self, chunk_size=None, trigger='manual'):
         if not chunk_size:
             chunk_size = self.chuncksize
-        self.tbl.insert_many(rows=self.stack,
-                             chunk_size=chunk_size)
-        self.conn.commit()
-        self.conn.begin
-        self.stack = []
+        with self._lock:
+            if not self.stack:
+                return
+            self.policy.triggered(trigger)
+            if self.background:
+                stack, self.stack = self.stack, []
+                nbytes, self.stackbytes = self.stackbytes, 0
+                self.writer.put((stack, nbytes, chunk_size))
+                return
+            self._write_rows((self.stack, self.stackbytes, chunk_size))
+            self.stack = []
+            self.stackbytes = 0
+
+    def _raise_error(self):
+        if self.background:
+            self.writer.raise_error()
+        if self._excinfo is not None:
+            excinfo, self._excinfo = self._excinfo, None
+            reraise(*excinfo)
+
+    def _push(self, rows):
+        with self._lock:
+            if not self.stack:
+                self.stackstart = time.time()
+            self.stack.extend(rows)
+            self.stackbytes += sum(row_nbytes(row) for row in rows)
+            trigger = self.policy.due(len(self.stack), self.stackbytes,
+                                      time.time() - self.stackstart)
+            if trigger is not None:
+                self.flush_the_stack(trigger=trigger)
+
+    def _linger(self):
+        """
+        Runs on the linger thread, flushes stacks that have waited too long.
+        """
+        while not self._closed.wait(self.policy.maxlinger / 2.0):
+            with self._lock:
+                if not self.stack:
+                    continue
+                trigger = self.policy.due(len(self.stack), self.stackbytes,
+                                          time.time() - self.stackstart)
+                if trigger is None:
+                    continue
+                try:
+                    self.flush_the_stack(trigger=trigger)
+                except Exception:
+                    LOG.error('SQLStash, linger flush failed')
+                    self._excinfo = sys.exc_info()
+                    return
 
     def stash(self, datumdict):
-        self.stack.append(datumdict)
-        if len(self.stack) >= self.chuncksize:
-            self.flush_the_stack()
+        self._raise_error()
+        self._push([datumdict])
+
+    def stash_many(self, datumdicts):
+        self._raise_error()
+        self._push(datumdicts)
+
+    def flush_stats(self):
+        return self.policy.summary()
 
     def close(self):
         LOG.debug('SQLStash, close has been called')
+        self._closed.set()
+        if self.policy.maxlinger:
+            self._lingerer.join()
+        self._raise_error()
         stacksize = len(self.stack) / 2
-        self.flush_the_stack(chunk_size=stacksize)
-        self.conn.commit()
+        self.flush_the_stack(chunk_size=stacksize, trigger='close')
+        if self.background:
+            self.writer.close()
+        if self.manifest is not None:
+            self.manifest.close()
+        LOG.info('SQLStash, flush stats:\t' + repr(self.flush_stats()))
 
     def __enter__(self):
         return self
@@ -8,64 +8,388 @@ from . import(__title__, __version__, __status__, __license__, __maintainer__,
               __email__)
 
 
+import os
+import re
+import sys
+import errno
+from hashlib import md5
+import shutil
+import tarfile
+import tempfile
 from os import getenv
+from io import BytesIO
 from functools import partial
-from collections import Iterable
+from collections import Iterable, namedtuple
 from copy import copy
+from uuid import uuid4
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Thread, Lock, Condition
+import multiprocessing
 
-from pathlib import Path
-from six.moves.urllib.parse import urlsplit
-import boto3
-from botocore.client import Config
+from pathlib import Path, PurePath
+from six.moves.urllib.parse import urlsplit, parse_qs
+from six.moves import queue
+from six import reraise
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
 
-from superserial.outsidemodules.threading_easy import threading_easy
-from superserial.outsidemodules.parallel_easy import map_easy
+from superserial.outsidemodules.threading_easy import threading_imap
 
-from superserial.utils import(pass_through,
-                              encrypt_it,
-                              get_default_data_key,
+from superserial.utils import(get_default_data_key,
+                              S3CLIENTS,
+                              pass_through,
                               flatten_array_like_strct_gen)
 from superserial.outsidemodules.smartopen import ParseUri
+from superserial.stashindex import dedup_index, manifest_index
+from superserial.envelope import(get_codec,
+                                 make_envelope,
+                                 make_stream_envelope,
+                                 is_stream,
+                                 envelope_pointer,
+                                 envelope_s3_args,
+                                 EncryptionStage)
 
 import logging
 LOG = logging.getLogger(__name__)
 
 
+# -----------------------------------------------------------------------------
+# Envelopes
+def _compress_executor(compressworkers, encrypt=False, encryptkey=None,
+                       codec=None, encryptworkers=1, envelope='fernet'):
+    if encrypt and (encryptworkers == 'auto' or encryptworkers > 1):
+        return EncryptionStage(encryptkey, codec=codec,
+                               workers=None if encryptworkers == 'auto'
+                               else encryptworkers,
+                               envelope=envelope)
+    if compressworkers > 1:
+        return ThreadPoolExecutor(max_workers=compressworkers)
+    return None
+
+
+def _envelope_many(envelope, contents, executor=None):
+    """
+    Applies envelope to every content, on the executor's threads if given
+    (zlib, zstandard and lz4 release the GIL while compressing), or on the
+    processes of an EncryptionStage.
+    """
+    if executor is None:
+        return [envelope(content) for content in contents]
+    elif isinstance(executor, EncryptionStage):
+        return executor.envelope_many(contents)
+    return list(executor.map(envelope, contents))
+
+
 # -----------------------------------------------------------------------------
 # Local File System
-class LocalFileStash(object):  # Add support for tar archives.
+DURABILITYMODES = {'none', 'batch', 'file'}
+
+
+def _fsync_path(path, datasync=False):
+    """
+    fsync (or fdatasync) a file or directory by path.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if datasync and hasattr(os, 'fdatasync'):
+            os.fdatasync(fd)
+        else:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fanout_path(pointer, levels=2, width=2):
+    """
+    Maps a pointer to its place in a hashed directory fan-out, e.g. with the
+    defaults:
+        /out/text/1234.txt -> /out/text/8f/3a/1234.txt
+    where the directories are the leading hex characters of the md5 of the
+    file name. Deterministic, so readers can find files without listing.
+    """
+    if not levels:
+        return pointer
+    dirname, basename = os.path.split(pointer)
+    if isinstance(basename, unicode):
+        digest = md5(basename.encode('utf-8')).hexdigest()
+    else:
+        digest = md5(basename).hexdigest()
+    shards = [digest[i * width:(i + 1) * width] for i in xrange(levels)]
+    return os.path.join(dirname, *(shards + [basename]))
+
+
+def _dedup(index, datumdicts, get_pointer, relocate):
+    """
+    The datums whose content isn't stored yet (streams are never checked).
+    relocate(source, target) copies a stored object the index moved off a
+    pointer that is about to be overwritten, see DedupIndex.
+    """
+    if index is None:
+        return datumdicts
+    datumdicts = [d for d in datumdicts
+                  if is_stream(d['content']) or index.claim(get_pointer(d),
+                                                            d['content'])]
+    for source, target in index.pop_relocations():
+        relocate(source, target)
+    return datumdicts
+
+
+@contextmanager
+def _dedup_guard(index):
+    """
+    If the block raises, forgets the claims made in it whose writes didn't
+    happen (writes report to the index with stored or forget themselves).
+    """
+    if index is None:
+        yield
+        return
+    mark = index.mark()
+    try:
+        yield
+    except:
+        index.forget_since(mark)
+        raise
+
+
+def _close_dedup(index):
+    if index is None:
+        return
+    LOG.info('Dedup:\t' + str(index.stats()))
+    index.close()
+
+
+def _close_manifest(manifest):
+    if manifest is not None:
+        manifest.close()
+
+
+def _makedirs(dirname):
+    try:
+        os.makedirs(dirname)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class LocalFileStash(object):
     """
     Used for streaming multiple files to the local file system.
+    (PackFileStash packs them into tar segments instead.)
 
     parenturi - is the directory where the files will be stored.
+    writers - number of threads writing files, if 1 files are written on the
+              calling thread. At most 'maxpending' writes wait for a writer.
+    durability - 'none' leaves flushing to the OS, 'batch' fdatasyncs every
+                 written file (and their directories) at close, 'file'
+                 fsyncs each file as it is written.
+    atomic - if True, content is written to a temp file in the same
+             directory and renamed into place, so readers never see
+             partial files.
+    fanout - number of hashed directory levels (of 'fanwidth' hex chars)
+             inserted between a pointer's directory and its file name, see
+             fanout_path. 0 stores files exactly where the pointers say.
+    compress - None, 'gzip', 'zstd' or 'lz4', compresses content before it is
+               (optionally) encrypted. Unencrypted content gets the codec's
+               extension added to its name (and ContentEncoding on s3).
+    compresslevel - the codec's compression level, None for its default.
+    envelope - how encrypted content is sealed: 'fernet' (default) or 'aead',
+               chunked AES-GCM that is binary (no base64, a third smaller)
+               and can be streamed and decrypted by range, see
+               envelope.AeadCipher. Both use encryptkey.
+    compressworkers - if > 1, stash_many compresses/encrypts on this many
+                      threads.
+    encryptworkers - if > 1 (or 'auto', one per core) and encrypt is set,
+                     stash_many compresses/encrypts on this many processes
+                     instead, see envelope.EncryptionStage. Its stats are
+                     logged on close.
+    dedup - skip storing content that is already stored: True for the
+            default index of parenturi, or the path of a DedupIndex
+            (see superserial.stashindex). Duplicates are only recorded,
+            as pointer -> content hash, in the index. Overwriting a file
+            that duplicates were skipped for copies it to one of them first.
+    manifest - record every written file in a Manifest: True for the
+               default manifest of parenturi, or its path. is_stashed(datum)
+               then tells whether a datum was already written, which is how
+               Gula.consume(resume=True) skips it.
 
-    The close method has no effect, it's only for creating a consistent API
-        with all of the Stash context managers.
+    Errors raised by writer threads are re-raised by the next call to stash
+    or close.
     """
     def __init__(self, parenturi, encrypt=False, removeExtIfEncrypt=True,
                  encryptkey=getenv('DAS_ENCRYPT_KEY', get_default_data_key()),
-                 **xargs):
+                 writers=1, maxpending=None, durability='none', atomic=True,
+                 fanout=0, fanwidth=2,
+                 compress=None, compresslevel=None, compressworkers=1,
+                 encryptworkers=1, dedup=None, manifest=None,
+                 envelope='fernet', **xargs):
+        if durability not in DURABILITYMODES:
+            raise ValueError('durability should be one of: ' +
+                             ', '.join(sorted(DURABILITYMODES)))
         self.parentpath = Path(urlsplit(parenturi).path)
         self.encrypt = encrypt
         self.removeExtIfEncrypt = removeExtIfEncrypt
+        self.durability = durability
+        self.atomic = atomic
+        self.fanout = fanout
+        self.fanwidth = fanwidth
+        self._madedirs = set()
+        self.written = []
+        self.errors = []
+        if writers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=writers)
+            self.maxpending = maxpending or 4 * writers
+            self.pending = BoundedSemaphore(self.maxpending)
+        else:
+            self.executor = None
         if not self.parentpath.is_dir():
             self.parentpath.mkdir(parents=True)
-        if encrypt:
-            self.envelope = partial(encrypt_it, key=encryptkey)
+        self.codec = get_codec(compress, level=compresslevel)
+        self.envelope = make_envelope(encrypt, encryptkey, self.codec,
+                                      envelope=envelope)
+        self.compressexecutor = _compress_executor(compressworkers, encrypt,
+                                                   encryptkey, self.codec,
+                                                   encryptworkers, envelope)
+        self.dedup = dedup_index(dedup, parenturi)
+        self.manifest = manifest_index(manifest, parenturi)
+
+    def _pointer(self, datumdict):
+        pointer = envelope_pointer(datumdict['pointer'],
+                                   self.encrypt, self.removeExtIfEncrypt,
+                                   self.codec)
+        if self.fanout:
+            return fanout_path(pointer, levels=self.fanout,
+                               width=self.fanwidth)
+        return pointer
+
+    def _write(self, pointer, content, sealed=False):
+        try:
+            self._write_file(pointer, content, sealed=sealed)
+        except:
+            if self.dedup is not None:
+                self.dedup.forget(pointer)
+            raise
+        if self.dedup is not None:
+            self.dedup.stored(pointer)
+
+    def _write_file(self, pointer, content, sealed=False):
+        path = pointer.encode('utf-8')
+        if self.fanout:
+            dirname = os.path.dirname(path)
+            if dirname not in self._madedirs:
+                _makedirs(dirname)
+                self._madedirs.add(dirname)
+        if not sealed:
+            content = self.envelope(content)
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        if self.atomic:
+            dirname, basename = os.path.split(path)
+            writepath = os.path.join(dirname, ''.join(['.', basename, '.',
+                                                        uuid4().hex[:8],
+                                                        '.tmp']))
         else:
-            self.envelope = pass_through
+            writepath = path
+        try:
+            with open(writepath, 'wb') as fp:
+                fp.write(content)
+                if self.durability == 'file':
+                    fp.flush()
+                    os.fsync(fp.fileno())
+            if self.atomic:
+                os.rename(writepath, path)
+        except:
+            if self.atomic and os.path.exists(writepath):
+                os.remove(writepath)
+            raise
+        if self.durability == 'file':
+            _fsync_path(os.path.dirname(path) or '.')
+        elif self.durability == 'batch':
+            self.written.append(path)
+        if self.manifest is not None:
+            self.manifest.add(pointer)
 
-    def stash(self, datumdict):
-        if self.encrypt and self.removeExtIfEncrypt:
-            pointer = datumdict['pointer'].split('.')[0]
+    def _written(self, future):
+        if future.exception() is not None:
+            self.errors.append(future.exception())
+        self.pending.release()
+
+    def _raise_errors(self):
+        if self.errors:
+            raise self.errors.pop(0)
+
+    def _stash(self, pointer, content, sealed=False):
+        self._raise_errors()
+        if self.executor is None:
+            self._write(pointer, content, sealed=sealed)
         else:
-            pointer = datumdict['pointer']
+            self.pending.acquire()
+            future = self.executor.submit(self._write, pointer, content,
+                                          sealed=sealed)
+            future.add_done_callback(self._written)
+
+    def is_stashed(self, datumdict):
+        return (self.manifest is not None and
+                self._pointer(datumdict) in self.manifest)
+
+    def _relocate(self, source, target):
+        if self.executor is not None:
+            # Waits for the writes in flight, 'source' may be one of them.
+            for _ in xrange(self.maxpending):
+                self.pending.acquire()
+            for _ in xrange(self.maxpending):
+                self.pending.release()
+            self._raise_errors()
+        source, target = source.encode('utf-8'), target.encode('utf-8')
+        dirname = os.path.dirname(target)
+        if dirname and not os.path.isdir(dirname):
+            _makedirs(dirname)
+        shutil.copyfile(source, target)
+        if self.manifest is not None:
+            self.manifest.add(target)
 
-        with open(pointer.encode('utf-8'), 'w+') as fp:
-            fp.write(self.envelope(datumdict['content']))
+    def stash(self, datumdict):
+        with _dedup_guard(self.dedup):
+            if _dedup(self.dedup, [datumdict], self._pointer,
+                      self._relocate):
+                self._stash(self._pointer(datumdict), datumdict['content'])
+
+    def stash_many(self, datumdicts):
+        with _dedup_guard(self.dedup):
+            datumdicts = _dedup(self.dedup, datumdicts, self._pointer,
+                                self._relocate)
+            if self.compressexecutor is None:
+                for datumdict in datumdicts:
+                    self._stash(self._pointer(datumdict), datumdict['content'])
+                return
+            contents = _envelope_many(self.envelope,
+                                      [d['content'] for d in datumdicts],
+                                      self.compressexecutor)
+            for datumdict, content in zip(datumdicts, contents):
+                self._stash(self._pointer(datumdict), content, sealed=True)
+
+    def sync(self):
+        """
+        fdatasyncs the files written since the last sync, then their
+        directories (so that the renames are durable too).
+        """
+        written, self.written = self.written, []
+        for path in written:
+            _fsync_path(path, datasync=True)
+        for dirname in set(os.path.dirname(path) or '.' for path in written):
+            _fsync_path(dirname)
 
     def close(self):
-        pass
+        try:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+            if self.compressexecutor is not None:
+                self.compressexecutor.shutdown(wait=True)
+            if self.durability == 'batch':
+                self.sync()
+            self._raise_errors()
+        finally:
+            _close_manifest(self.manifest)
+            _close_dedup(self.dedup)
 
     def __enter__(self):
         return self
@@ -76,8 +400,24 @@ class LocalFileStash(object):  # Add support for tar archives.
 
 # -----------------------------------------------------------------------------
 # S3
-def s3_stash_object(bucket, key, body, client, acl='private', encrypt=True, **xargs):
+S3PASSTHROUGHARGS = ('Metadata', 'ContentEncoding', 'ContentType')
+MULTIPARTTHRESHOLD = 8 * 1024 ** 2
+PARTSIZE = 8 * 1024 ** 2
+PARTCONCURRENCY = 4
+
+
+def s3_stash_object(bucket, key, body, client, acl='private', encrypt=True,
+                    multipartthreshold=MULTIPARTTHRESHOLD, partsize=PARTSIZE,
+                    partconcurrency=PARTCONCURRENCY,
+                    **xargs):
     """
+    body - bytes, a file-like object or a pathlib path to a file.
+           File-like and path bodies are streamed, never read into memory
+           as a whole. Bodies bigger than 'multipartthreshold' bytes are
+           sent as a multipart upload, in parts of 'partsize' bytes with
+           'partconcurrency' parts in flight, so a transient error only
+           retries one part.
+
     if encrypt is true (default) then s3 will use server side aes256 encryption,
     which shouldn't cause a noticeable difference in use of the objects stored.
     (assuming they are intended to be non-public)
@@ -108,12 +448,30 @@ def s3_stash_object(bucket, key, body, client, acl='private', encrypt=True, **xa
     except KeyError:
         if xargs['kmsencrypt']:
             s3args['SSEKMSKeyId'] = xargs['kmskeyid']
-    # client = boto3.client('s3', config=Config(signature_version='s3v4'))
-    return client.put_object(ACL=acl,
-                             Bucket=bucket,
-                             Key=key,
-                             Body=body,
-                             **s3args)
+    for arg in S3PASSTHROUGHARGS:
+        if arg in xargs:
+            s3args[arg] = xargs[arg]
+    if not is_stream(body) and len(body) < multipartthreshold:
+        return client.put_object(ACL=acl,
+                                 Bucket=bucket,
+                                 Key=key,
+                                 Body=body,
+                                 **s3args)
+    transferconfig = TransferConfig(multipart_threshold=multipartthreshold,
+                                    multipart_chunksize=partsize,
+                                    max_concurrency=partconcurrency)
+    s3args['ACL'] = acl
+    if isinstance(body, PurePath):
+        with open(str(body), 'rb') as fp:
+            client.upload_fileobj(fp, bucket, key, ExtraArgs=s3args,
+                                  Config=transferconfig)
+    elif is_stream(body):
+        client.upload_fileobj(body, bucket, key, ExtraArgs=s3args,
+                              Config=transferconfig)
+    else:
+        client.upload_fileobj(BytesIO(body), bucket, key, ExtraArgs=s3args,
+                              Config=transferconfig)
+    return {'Bucket': bucket, 'Key': key, 'Multipart': True}
 
 
 class S3FileStash(object):
@@ -130,34 +488,123 @@ class S3FileStash(object):
 
     passing 'serversideencryption' and 'ssekmskeyid' will override the default
     encryption method and use the one specified.
+
+    compress, compresslevel, compressworkers, encryptworkers, envelope - as
+        for LocalFileStash.
+
+    multipartthreshold, partsize, partconcurrency - objects above the
+        threshold are sent as parallel multipart uploads, see s3_stash_object.
+    A datum's content can also be a file-like object or a pathlib path, it
+    is then streamed (and compressed on the fly) instead of read into memory.
+
+    dedup, manifest - as for LocalFileStash. seed_manifest records the
+                      objects already in the bucket, with one listing.
     """
     def __init__(self, parenturi, encrypt=False, removeExtIfEncrypt=True,
                  encryptkey=getenv('DAS_ENCRYPT_KEY', get_default_data_key()),
-                 **otherArgsForS3):
+                 compress=None, compresslevel=None, compressworkers=1,
+                 encryptworkers=1, dedup=None, manifest=None,
+                 envelope='fernet', **otherArgsForS3):
         self.parentpath = Path(urlsplit(parenturi).path)
         self.encrypt = encrypt
         self.removeExtIfEncrypt = removeExtIfEncrypt
         self.parsedParentUri = ParseUri(parenturi)
-        self.client = boto3.client('s3', config=Config(signature_version='s3v4'))
-        self.post_it = partial(s3_stash_object,
-                               client=self.client,
-                               bucket=str(self.parsedParentUri.bucket_id),
-                               encrypt=encrypt,
-                               **otherArgsForS3)
-        if encrypt:
-            self.envelope = partial(encrypt_it, key=encryptkey)
-        else:
-            self.envelope = pass_through
+        self.codec = get_codec(compress, level=compresslevel)
+        partconcurrency = otherArgsForS3.get('partconcurrency', PARTCONCURRENCY)
+        self.client = S3CLIENTS.client(maxconnections=max(10, partconcurrency))
+        otherArgsForS3.update(envelope_s3_args(encrypt, self.codec))
+        self._post_it = partial(s3_stash_object,
+                                client=self.client,
+                                bucket=str(self.parsedParentUri.bucket_id),
+                                encrypt=encrypt,
+                                **otherArgsForS3)
+        self.envelope = make_envelope(encrypt, encryptkey, self.codec,
+                                      envelope=envelope)
+        self.stream_envelope = make_stream_envelope(encrypt, encryptkey,
+                                                    self.codec,
+                                                    envelope=envelope)
+        self.compressexecutor = _compress_executor(compressworkers, encrypt,
+                                                   encryptkey, self.codec,
+                                                   encryptworkers, envelope)
+        self.dedup = dedup_index(dedup, parenturi)
+        self.manifest = manifest_index(manifest, parenturi)
+
+    def post_it(self, key, body):
+        try:
+            response = self._post_it(key=key, body=body)
+        except:
+            if self.dedup is not None:
+                self.dedup.forget(key)
+            raise
+        if self.dedup is not None:
+            self.dedup.stored(key)
+        if self.manifest is not None:
+            self.manifest.add(key)
+        return response
+
+    def seed_manifest(self):
+        return self.manifest.seed_s3(self.client,
+                                     str(self.parsedParentUri.bucket_id),
+                                     prefix=self.parsedParentUri.key_id)
+
+    def is_stashed(self, datumdict):
+        return (self.manifest is not None and
+                self._pointer(datumdict) in self.manifest)
+
+    def _pointer(self, datumdict):
+        return envelope_pointer(ParseUri(datumdict['pointer']).key_id.encode('utf-8'),
+                                self.encrypt, self.removeExtIfEncrypt,
+                                self.codec)
+
+    def _relocate(self, source, target):
+        bucket = str(self.parsedParentUri.bucket_id)
+        self.client.copy_object(Bucket=bucket, Key=target,
+                                CopySource={'Bucket': bucket, 'Key': source})
+        if self.manifest is not None:
+            self.manifest.add(target)
+
+    def _post_stream(self, key, content):
+        if isinstance(content, PurePath):
+            if self.stream_envelope is pass_through:
+                return self.post_it(key=key, body=content)
+            with open(str(content), 'rb') as fp:
+                return self.post_it(key=key, body=self.stream_envelope(fp))
+        return self.post_it(key=key, body=self.stream_envelope(content))
 
     def stash(self, datumdict):
-        pointer = ParseUri(datumdict['pointer']).key_id.encode('utf-8')
-        if self.encrypt and self.removeExtIfEncrypt:
-            pointer = pointer.split('.')[0]
-        self.post_it(key=pointer,
-                     body=self.envelope(datumdict['content']))
+        if is_stream(datumdict['content']):
+            self._post_stream(self._pointer(datumdict), datumdict['content'])
+            return
+        with _dedup_guard(self.dedup):
+            if _dedup(self.dedup, [datumdict], self._pointer,
+                      self._relocate):
+                self.post_it(key=self._pointer(datumdict),
+                             body=self.envelope(datumdict['content']))
+
+    def stash_many(self, datumdicts):
+        streams = [d for d in datumdicts if is_stream(d['content'])]
+        if streams:
+            for datumdict in streams:
+                self._post_stream(self._pointer(datumdict),
+                                  datumdict['content'])
+            datumdicts = [d for d in datumdicts if not is_stream(d['content'])]
+        get_pointer = self._pointer
+        post_it = self.post_it
+        with _dedup_guard(self.dedup):
+            datumdicts = _dedup(self.dedup, datumdicts, get_pointer,
+                                self._relocate)
+            bodies = _envelope_many(self.envelope,
+                                    [d['content'] for d in datumdicts],
+                                    self.compressexecutor)
+            for datumdict, body in zip(datumdicts, bodies):
+                post_it(key=get_pointer(datumdict),
+                        body=body)
 
     def close(self):
-        pass
+        if self.compressexecutor is not None:
+            self.compressexecutor.shutdown(wait=True)
+        _close_dedup(self.dedup)
+        _close_manifest(self.manifest)
 
     def __enter__(self):
         return self
@@ -168,7 +615,8 @@ class S3FileStash(object):
 
 def _s3_stash_object_kv_spltr(keyvalue, **xargs):
     if (len(keyvalue) > 2) and isinstance(keyvalue, Iterable):
-        return (_s3_stash_object_kv_spltr(keyvalue=kv, **xargs) for kv in keyvalue)
+        # A list, so the nested uploads run on the worker thread that got them.
+        return [_s3_stash_object_kv_spltr(keyvalue=kv, **xargs) for kv in keyvalue]
     else:
         output = s3_stash_object(key=keyvalue[0], body=keyvalue[1], **xargs)
         if output:
@@ -180,27 +628,192 @@ def _s3_stash_object_kv_spltr(keyvalue, **xargs):
 def s3_stash_objects_threaded(keyvalueiter, bucket, threads=5,
                               acl='private', encrypt=True, **xargs):
 
-    client = boto3.client('s3', config=Config(signature_version='s3v4'))
+    client = S3CLIENTS.client(maxconnections=max(10, threads))
     s3_stash_thrdd_prtl = partial(_s3_stash_object_kv_spltr, bucket=bucket, client=client,
                                   acl=acl, encrypt=encrypt, **xargs)
     LOG.info('\t'.join(['keyvalueiter size:', str(len(keyvalueiter)),
                         'keyvalueiter type:', str(type(keyvalueiter))]))
-    kvgen = (i for i in keyvalueiter)
-    return [output for output in flatten_array_like_strct_gen(threading_easy(s3_stash_thrdd_prtl,
-                                                                             kvgen,
-                                                                             n_threads=threads))]
+    return list(flatten_array_like_strct_gen(
+        threading_imap(s3_stash_thrdd_prtl, keyvalueiter, n_threads=threads,
+                       ordered=False)))
 
 
-def _s3_stash_objects_parallel(keyvalueiter, bucket, vcores=1, threads=5,
-                               acl='private', encrypt=True, **xargs):
-    s3_stash_thrdd_prtl = partial(s3_stash_objects_threaded, bucket=bucket, threads=threads,
-                                  acl=acl, encrypt=encrypt, **xargs)
-    LOG.info('\t'.join(['keyvalueiter size:', str(len(keyvalueiter)),
-                        'keyvalueiter type:', str(type(keyvalueiter))]))
-    for output in flatten_array_like_strct_gen(map_easy(s3_stash_thrdd_prtl,
-                                                        list(keyvalueiter),
-                                                        n_jobs=vcores)):
-        yield output
+UploadResult = namedtuple('UploadResult', ['key', 'response', 'error'])
+
+_STOPUPLOAD = None
+
+
+def _upload_process(tasks, results, bucket, threads, s3args):
+    """
+    Runs in a worker process of an S3Uploader: uploads what comes off
+    'tasks' with its own threads and client, sends results back.
+    """
+    def send(result):
+        error = result.error
+        if error is not None:
+            # Not every botocore error pickles.
+            error = repr(error)
+        results.put(UploadResult(result.key, result.response, error))
+
+    uploader = S3Uploader(bucket, threads=threads, onresult=send,
+                          raiseerrors=False, **s3args)
+    for key, body in iter(tasks.get, _STOPUPLOAD):
+        uploader.put(key, body)
+    uploader.close()
+    results.put(_STOPUPLOAD)
+
+
+class S3Uploader(object):
+    """
+    Long-lived pool of upload threads pulling (key, body) pairs off a
+    bounded queue, so there are always 'threads' uploads in flight and put
+    blocks once 'queuedepth' objects are waiting (back-pressure).
+
+    processes - when above 1 the threads are spread over that many worker
+                processes, each with its own client and 'threads' threads.
+                Bodies must then be picklable (bytes or paths).
+    onresult - called with an UploadResult(key, response, error) for every
+               object, from the upload threads.
+    raiseerrors - if true (default) close re-raises the first failed upload,
+                  after every queued object has been tried.
+    keepresults - if true, results keeps every object's UploadResult
+                  (responses included), otherwise only the failed ones,
+                  so memory stays flat however many objects are uploaded.
+
+    results - the kept UploadResults, in completion order.
+    uploaded, failed - the number of objects uploaded / failed so far.
+    The rest of the kwargs go to s3_stash_object.
+    """
+    def __init__(self, bucket, threads=50, processes=1, queuedepth=None,
+                 client=None, onresult=None, raiseerrors=True,
+                 keepresults=False, **s3args):
+        self.bucket = bucket
+        self.threads = threads
+        self.processes = processes
+        self.onresult = onresult
+        self.raiseerrors = raiseerrors
+        self.keepresults = keepresults
+        self.results = []
+        self.uploaded = 0
+        self.failed = 0
+        self.excinfo = None
+        self.lock = Lock()
+        self.done = Condition(self.lock)
+        self.outstanding = 0
+        if queuedepth is None:
+            queuedepth = 2 * threads * processes
+        s3args.setdefault('kmsencrypt', False)
+        if processes > 1:
+            self.tasks = multiprocessing.Queue(maxsize=queuedepth)
+            self.resultqueue = multiprocessing.Queue()
+            self.workers = [multiprocessing.Process(target=_upload_process,
+                                                    args=(self.tasks,
+                                                          self.resultqueue,
+                                                          bucket, threads,
+                                                          s3args))
+                            for _ in range(processes)]
+            for worker in self.workers:
+                worker.daemon = True
+                worker.start()
+            self.threadpool = [Thread(target=self._collect)]
+        else:
+            if client is None:
+                partconcurrency = s3args.get('partconcurrency', PARTCONCURRENCY)
+                client = S3CLIENTS.client(maxconnections=max(10, threads * partconcurrency))
+            self.upload = partial(s3_stash_object, bucket=bucket,
+                                  client=client, **s3args)
+            self.tasks = queue.Queue(maxsize=queuedepth)
+            self.workers = []
+            self.threadpool = [Thread(target=self._run)
+                               for _ in range(threads)]
+        for thread in self.threadpool:
+            thread.daemon = True
+            thread.start()
+        self.closed = False
+
+    def _record(self, result, excinfo=None):
+        with self.lock:
+            if result.error is None:
+                self.uploaded += 1
+            else:
+                self.failed += 1
+            if self.keepresults or result.error is not None:
+                self.results.append(result)
+            if excinfo is not None and self.excinfo is None:
+                self.excinfo = excinfo
+            self.outstanding -= 1
+            self.done.notify_all()
+        if self.onresult is not None:
+            self.onresult(result)
+
+    def _run(self):
+        for key, body in iter(self.tasks.get, _STOPUPLOAD):
+            try:
+                response = self.upload(key=key, body=body)
+            except Exception as error:
+                LOG.error('Upload of ' + str(key) + ' failed:\t' + repr(error))
+                self._record(UploadResult(key, None, error), sys.exc_info())
+            else:
+                self._record(UploadResult(key, response, None))
+
+    def _collect(self):
+        stopped = 0
+        while stopped < self.processes:
+            result = self.resultqueue.get()
+            if result is _STOPUPLOAD:
+                stopped += 1
+                continue
+            excinfo = None
+            if result.error is not None:
+                try:
+                    raise IOError('Upload of ' + str(result.key) +
+                                  ' failed: ' + result.error)
+                except IOError:
+                    excinfo = sys.exc_info()
+            self._record(result, excinfo)
+
+    def put(self, key, body):
+        if self.closed:
+            raise ValueError('put on a closed S3Uploader')
+        with self.lock:
+            self.outstanding += 1
+        self.tasks.put((key, body))
+
+    def put_many(self, keyvalueiter):
+        for key, body in keyvalueiter:
+            self.put(key, body)
+
+    def wait(self):
+        """
+        Blocks until every object put so far has been uploaded (or failed).
+        """
+        with self.lock:
+            while self.outstanding > 0:
+                self.done.wait()
+
+    def close(self):
+        """
+        Waits until every queued object has been uploaded (or has failed),
+        stops the workers and returns the results.
+        """
+        if not self.closed:
+            self.closed = True
+            for _ in range(len(self.workers) or len(self.threadpool)):
+                self.tasks.put(_STOPUPLOAD)
+            for worker in self.workers:
+                worker.join()
+            for thread in self.threadpool:
+                thread.join()
+        if self.raiseerrors and self.excinfo is not None:
+            excinfo, self.excinfo = self.excinfo, None
+            reraise(*excinfo)
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
 
 
 class S3FileStashPool(object):
@@ -217,11 +830,30 @@ class S3FileStashPool(object):
 
     passing 'serversideencryption' and 'ssekmskeyid' will override the default
     encryption method and use the one specified.
+
+    compress, compresslevel, compressworkers, encryptworkers, envelope - as
+        for LocalFileStash.
+
+    multipartthreshold, partsize, partconcurrency - as for S3FileStash.
+    Content given as a pathlib path is opened and streamed by the uploading
+    worker when no envelope applies; file-like content is read into memory,
+    since it has to be handed to the worker processes.
+
+    Uploads run on an S3Uploader: 'threads' upload threads in each of
+    'vcores' processes, kept busy from a queue holding up to 'batch'
+    objects per process. close waits for every upload; results has the
+    failed uploads (every object's outcome with keepresults=True), see
+    S3Uploader.
+
+    dedup, manifest - as for S3FileStash, uploads are added to the manifest
+                      as they succeed.
     """
     def __init__(self, parenturi, encrypt=False, removeExtIfEncrypt=True,
                  encryptkey=getenv('DAS_ENCRYPT_KEY', get_default_data_key()),
                  vcores=1, threads=50, batch=200,
-                 **otherArgsForS3):
+                 compress=None, compresslevel=None, compressworkers=1,
+                 encryptworkers=1, dedup=None, manifest=None,
+                 envelope='fernet', **otherArgsForS3):
         self.vcores = vcores
         self.threads = threads
         self.batch = batch
@@ -229,51 +861,260 @@ class S3FileStashPool(object):
         self.encrypt = encrypt
         self.removeExtIfEncrypt = removeExtIfEncrypt
         self.parsedParentUri = ParseUri(parenturi)
-        self.post_it = partial(_s3_stash_objects_parallel,
-                               vcores=vcores,
-                               threads=threads,
-                               bucket=str(self.parsedParentUri.bucket_id),
-                               encrypt=encrypt,
-                               **otherArgsForS3)
-
-        if encrypt:
-            self.envelope = partial(encrypt_it, key=encryptkey)
+        self.codec = get_codec(compress, level=compresslevel)
+        otherArgsForS3.update(envelope_s3_args(encrypt, self.codec))
+        self.manifest = manifest_index(manifest, parenturi)
+        self.dedup = dedup_index(dedup, parenturi)
+        self.uploader = S3Uploader(str(self.parsedParentUri.bucket_id),
+                                   threads=threads,
+                                   processes=vcores,
+                                   queuedepth=batch * vcores,
+                                   encrypt=encrypt,
+                                   onresult=self._uploaded,
+                                   **otherArgsForS3)
+
+        self.envelope = make_envelope(encrypt, encryptkey, self.codec,
+                                      envelope=envelope)
+        self.compressexecutor = _compress_executor(compressworkers, encrypt,
+                                                   encryptkey, self.codec,
+                                                   encryptworkers, envelope)
+
+    @property
+    def results(self):
+        return self.uploader.results
+
+    def _uploaded(self, result):
+        if self.dedup is not None:
+            if result.error is None:
+                self.dedup.stored(result.key)
+            else:
+                self.dedup.forget(result.key)
+        if result.error is None and self.manifest is not None:
+            self.manifest.add(result.key)
+
+    def seed_manifest(self):
+        return self.manifest.seed_s3(S3CLIENTS.client(),
+                                     str(self.parsedParentUri.bucket_id),
+                                     prefix=self.parsedParentUri.key_id)
+
+    def is_stashed(self, datumdict):
+        return (self.manifest is not None and
+                self._pointer(datumdict) in self.manifest)
+
+    def _pointer(self, datumdict):
+        return envelope_pointer(ParseUri(datumdict['pointer']).key_id.encode('utf-8'),
+                                self.encrypt, self.removeExtIfEncrypt,
+                                self.codec)
+
+    def _relocate(self, source, target):
+        # 'source' may still be queued for upload.
+        self.uploader.wait()
+        bucket = str(self.parsedParentUri.bucket_id)
+        S3CLIENTS.client().copy_object(Bucket=bucket, Key=target,
+                                       CopySource={'Bucket': bucket,
+                                                   'Key': source})
+        if self.manifest is not None:
+            self.manifest.add(target)
+
+    def _content(self, content):
+        # File objects can't be sent to the worker processes, paths can.
+        if isinstance(content, PurePath):
+            if self.envelope is pass_through:
+                return content
+            with open(str(content), 'rb') as fp:
+                return fp.read()
+        elif hasattr(content, 'read'):
+            return content.read()
+        return content
+
+    def _body(self, content):
+        if isinstance(content, PurePath):
+            return content
+        return self.envelope(content)
+
+    def stash(self, datumdict):
+        with _dedup_guard(self.dedup):
+            if _dedup(self.dedup, [datumdict], self._pointer,
+                      self._relocate):
+                self.uploader.put(self._pointer(datumdict),
+                                  self._body(self._content(datumdict['content'])))
+
+    def stash_many(self, datumdicts):
+        get_pointer = self._pointer
+        with _dedup_guard(self.dedup):
+            datumdicts = _dedup(self.dedup, datumdicts, get_pointer,
+                                self._relocate)
+            contents = [self._content(d['content']) for d in datumdicts]
+            if any(isinstance(c, PurePath) for c in contents):
+                bodies = [self._body(c) for c in contents]
+            else:
+                bodies = _envelope_many(self.envelope, contents,
+                                        self.compressexecutor)
+            LOG.info('Objs count:\t' + str(len(bodies)))
+            self.uploader.put_many((get_pointer(datumdict), body)
+                                   for datumdict, body in zip(datumdicts,
+                                                              bodies))
+
+    def close(self):
+        try:
+            self.uploader.close()
+        finally:
+            if self.compressexecutor is not None:
+                self.compressexecutor.shutdown(wait=True)
+            _close_manifest(self.manifest)
+            _close_dedup(self.dedup)
+        LOG.info('Uploaded:\t' + str(self.uploader.uploaded) +
+                 '\tFailed:\t' + str(self.uploader.failed))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+# -----------------------------------------------------------------------------
+# Pack Files
+PACKSUFFIX = '.tar'
+INDEXSUFFIX = '.idx'
+_INDEXSEPARATORS = re.compile(r'[\t\r\n]')
+DEFAULTPACKSIZE = 64 * 1024 ** 2
+
+_SIZEUNITS = {'': 1, 'B': 1,
+              'K': 1024, 'KB': 1024,
+              'M': 1024 ** 2, 'MB': 1024 ** 2,
+              'G': 1024 ** 3, 'GB': 1024 ** 3,
+              }
+
+
+def parse_size(size):
+    """
+    Turns sizes like 67108864, '64MB', '512k' into a number of bytes.
+    """
+    if isinstance(size, (int, long)):
+        return size
+    match = re.match(r'^\s*(\d+)\s*([a-zA-Z]*)\s*$', str(size))
+    if not match or match.group(2).upper() not in _SIZEUNITS:
+        raise ValueError('Not a valid size: ' + repr(size))
+    return int(match.group(1)) * _SIZEUNITS[match.group(2).upper()]
+
+
+class PackFileStash(object):
+    """
+    Appends many datums into rolling tar segments (local or on s3) instead of
+    writing one file/object per datum.
+
+    parenturi - the directory or bucket (and 'folder') where the segments go.
+    packsize - a segment is closed, and a new one started, once it reaches
+               this size (bytes or e.g. '64MB').
+
+    Every segment gets a sidecar index (segment name + '.idx') with one line
+    per datum:
+        pointer \t segment \t offset \t length
+    where offset and length locate the (enveloped) content within the
+    segment, see PackFileReader. Segments are regular tar files, started on
+    the first datum they hold. Pointers can't contain tabs or newlines.
+
+    s3 segments are built in a local spool directory and uploaded, with their
+    index, when they are closed.
+
+    compress, compresslevel, envelope - as for LocalFileStash, applied to
+        each datum.
+    """
+    def __init__(self, parenturi, encrypt=False, removeExtIfEncrypt=True,
+                 encryptkey=getenv('DAS_ENCRYPT_KEY', get_default_data_key()),
+                 packsize=DEFAULTPACKSIZE, packid=None,
+                 compress=None, compresslevel=None, envelope='fernet',
+                 **otherArgsForS3):
+        self.parsedParentUri = ParseUri(parenturi)
+        self.encrypt = encrypt
+        self.removeExtIfEncrypt = removeExtIfEncrypt
+        self.codec = get_codec(compress, level=compresslevel)
+        self.packsize = parse_size(packsize)
+        self.packid = packid or str(uuid4()).split('-')[0]
+        self.s3 = self.parsedParentUri.scheme in {'s3', 's3n'}
+        if self.s3:
+            self.spooldir = Path(tempfile.mkdtemp(prefix='superserial-pack-'))
+            self.client = S3CLIENTS.client()
+            self.post_it = partial(s3_stash_object,
+                                   client=self.client,
+                                   bucket=str(self.parsedParentUri.bucket_id),
+                                   encrypt=encrypt,
+                                   **otherArgsForS3)
         else:
-            self.envelope = pass_through
-
-        self.innerstack = []
-        self.outerstack = []
-
-    def _place_on_outerstack(self, stack):
-        LOG.info('Stack type:\t' + str(type(stack)))
-        self.outerstack.append(stack)
-        if self.outerstack >= self.vcores:
-            LOG.info('\t'.join(['outerstack size:', str(len(self.outerstack)),
-                                'outerstack type:', str(type(self.outerstack))]))
-            for output in flatten_array_like_strct_gen(self.post_it(tuple(self.outerstack))):
-                LOG.debug(str(output))
-            # del(self.outerstack)
-            self.outerstack = []
-
-    def _place_on_innerstack(self, obj):
-        LOG.info('Obj type:\t' + str(type(obj)))
-        self.innerstack.append(obj)
-        if len(self.innerstack) >= self.batch:
-            LOG.info('\t'.join(['innerstack size:', str(len(self.innerstack)),
-                                'innerstack type:', str(type(self.innerstack))]))
-            self._place_on_outerstack(stack=tuple(self.innerstack))
-            # del(self.innerstack)
-            self.innerstack = []
+            self.spooldir = Path(self.parsedParentUri.uri_path)
+            if not self.spooldir.is_dir():
+                self.spooldir.mkdir(parents=True)
+        self.envelope = make_envelope(encrypt, encryptkey, self.codec,
+                                      envelope=envelope)
+        self.segmentnumber = -1
+        self.segment = None
+
+    def _segment_name(self):
+        return ''.join([self.packid, '-', '%06d' % self.segmentnumber,
+                        PACKSUFFIX])
+
+    def _roll(self):
+        self._close_segment()
+        self.segmentnumber += 1
+        self.segmentname = self._segment_name()
+        self.segmentpath = self.spooldir / self.segmentname
+        self.segment = tarfile.open(str(self.segmentpath), 'w',
+                                    format=tarfile.PAX_FORMAT)
+        self.index = open(str(self.segmentpath) + INDEXSUFFIX, 'w')
+
+    def _close_segment(self):
+        if self.segment is None:
+            return
+        self.segment.close()
+        self.index.close()
+        self.segment = None
+        if self.s3:
+            prefix = self.parsedParentUri.key_id
+            for path in (self.segmentpath,
+                         Path(str(self.segmentpath) + INDEXSUFFIX)):
+                self.post_it(key=prefix + path.name, body=path)
+                path.unlink()
+        LOG.info('PackFileStash, closed segment:\t' + self.segmentname)
+
+    def _pointer(self, datumdict):
+        return envelope_pointer(datumdict['pointer'],
+                                self.encrypt, self.removeExtIfEncrypt,
+                                self.codec)
 
     def stash(self, datumdict):
-        pointer = ParseUri(datumdict['pointer']).key_id.encode('utf-8')
-        if self.encrypt and self.removeExtIfEncrypt:
-            pointer = pointer.split('.')[0]
-        self._place_on_innerstack(obj=(pointer,
-                                       self.envelope(datumdict['content'])))
+        pointer = self._pointer(datumdict)
+        if _INDEXSEPARATORS.search(pointer):
+            raise ValueError('PackFileStash pointers cannot contain tabs or '
+                             'newlines: ' + repr(pointer))
+        if self.segment is None:
+            self._roll()
+        content = self.envelope(datumdict['content'])
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        info = tarfile.TarInfo(name=pointer.encode('utf-8').lstrip('/'))
+        info.size = len(content)
+        self.segment.addfile(info, BytesIO(content))
+        # The data ends the member, padded up to the next block.
+        blocks, remainder = divmod(info.size, tarfile.BLOCKSIZE)
+        if remainder:
+            blocks += 1
+        offset = self.segment.offset - blocks * tarfile.BLOCKSIZE
+        self.index.write('\t'.join([pointer.encode('utf-8'),
+                                    self.segmentname,
+                                    str(offset),
+                                    str(info.size)]) + '\n')
+        if self.segment.offset >= self.packsize:
+            self._close_segment()
+
+    def stash_many(self, datumdicts):
+        for datumdict in datumdicts:
+            self.stash(datumdict)
 
     def close(self):
-        pass
+        self._close_segment()
+        if self.s3:
+            shutil.rmtree(str(self.spooldir), ignore_errors=True)
 
     def __enter__(self):
         return self
@@ -282,6 +1123,61 @@ class S3FileStashPool(object):
         self.close()
 
 
+class PackFileReader(object):
+    """
+    Random access to the datums written by PackFileStash.
+
+    parenturi - the directory or bucket (and 'folder') holding the segments.
+
+    get(pointer) returns the stored (enveloped) content, reading only its
+    bytes (a ranged GET on s3).
+    """
+    def __init__(self, parenturi):
+        self.parsedParentUri = ParseUri(parenturi)
+        self.s3 = self.parsedParentUri.scheme in {'s3', 's3n'}
+        self.locations = {}
+        if self.s3:
+            self.bucket = str(self.parsedParentUri.bucket_id)
+            self.prefix = self.parsedParentUri.key_id
+            self.client = S3CLIENTS.client()
+            paginator = self.client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+                for obj in page.get('Contents', []):
+                    if obj['Key'].endswith(INDEXSUFFIX):
+                        body = self.client.get_object(Bucket=self.bucket,
+                                                      Key=obj['Key'])['Body']
+                        self._load_index(body.read().splitlines())
+        else:
+            self.parentpath = Path(self.parsedParentUri.uri_path)
+            for path in self.parentpath.glob('*' + PACKSUFFIX + INDEXSUFFIX):
+                with open(str(path)) as fp:
+                    self._load_index(fp)
+
+    def _load_index(self, lines):
+        for line in lines:
+            pointer, segment, offset, length = line.rstrip('\n').split('\t')
+            self.locations[pointer.decode('utf-8')] = (segment,
+                                                       int(offset),
+                                                       int(length))
+
+    def __contains__(self, pointer):
+        return pointer in self.locations
+
+    def __len__(self):
+        return len(self.locations)
+
+    def get(self, pointer):
+        segment, offset, length = self.locations[pointer]
+        if self.s3:
+            byterange = 'bytes=%d-%d' % (offset, offset + length - 1)
+            return self.client.get_object(Bucket=self.bucket,
+                                          Key=self.prefix + segment,
+                                          Range=byterange)['Body'].read()
+        with open(str(self.parentpath / segment), 'rb') as fp:
+            fp.seek(offset)
+            return fp.read(length)
+
+
 # -----------------------------------------------------------------------------
 # All Locations
 def file_stash(parenturi, encrypt=False, pool=False,
@@ -290,9 +1186,23 @@ def file_stash(parenturi, encrypt=False, pool=False,
     """
     parenturi - is the directory or bucket (and 'folder')
                 where the files will be stored.
+                A 'pack' query option, e.g. 'file:///mnt/output/text/?pack=64MB'
+                (or just '?pack=1' for the default size), packs the datums
+                into rolling segments with a PackFileStash.
 
     Returns the appropriate obj for stashing based on the parenturi.
     """
+    splituri = urlsplit(parenturi)
+    if splituri.query:
+        options = parse_qs(splituri.query)
+        parenturi = splituri._replace(query='').geturl()
+        if 'pack' in options:
+            packsize = options['pack'][0]
+            if packsize in {'1', 'true', 'True'}:
+                packsize = DEFAULTPACKSIZE
+            return PackFileStash(parenturi, encrypt=encrypt,
+                                 encryptkey=encryptkey, packsize=packsize,
+                                 **xargs)
     parseduri = ParseUri(parenturi)
     if parseduri.scheme in {'file'}:
         return LocalFileStash(parenturi, encrypt=encrypt, encryptkey=encryptkey,
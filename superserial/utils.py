@@ -25,14 +25,20 @@ import subprocess
 from uuid import uuid4
 import time
 import datetime
+import threading
+from six.moves import queue
+from six import reraise
 from getpass import getuser
 from hashlib import md5
 import pydoc
+from contextlib import contextmanager
 
 from dataset import connect, Database
 import pathlib
-from psycopg2 import connect as psyconnect
 from psycopg2.extras import DictCursor
+from sqlalchemy import create_engine
+import boto3
+from botocore.client import Config
 import dill
 import yaml
 try:
@@ -64,25 +70,244 @@ def dataset_find_cndm(*morekeys, **xargs):
     return xargs_cndm(*defaultkeys.union(set(morekeys)), **xargs)
 
 
+# -------------------------------------
+# Connection Pools
+
+class EngineRegistry(object):
+    """
+    Process wide registry of SQLAlchemy engines, keyed by uri, so that
+    SQLStash and the query helpers share one connection pool per database
+    instead of connecting (and handshaking) on every call.
+
+    poolsize, maxoverflow - size of each pool (ignored for sqlite, which
+                            keeps its own pooling).
+    preping - test connections for liveness before handing them out.
+    recycle - seconds after which pooled connections are replaced.
+
+    Read only helpers can be routed to a replica with route_reads, e.g.
+        ENGINES.route_reads(DEFAULTDB, DEFAULTDB2)
+
+    Pooled uris get one dataset.Database each (see database), whose engine
+    is the registered engine, so dataset users share the pool without
+    building engines of their own.
+
+    The registry is emptied in forked children (pooled connections can't be
+    shared across processes).
+    """
+    def __init__(self, poolsize=5, maxoverflow=10, preping=True,
+                 recycle=3600):
+        self.poolsize = poolsize
+        self.maxoverflow = maxoverflow
+        self.preping = preping
+        self.recycle = recycle
+        self.replicas = {}
+        self._engines = {}
+        self._databases = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def configure(self, poolsize=None, maxoverflow=None, preping=None,
+                  recycle=None):
+        """
+        Changes the pool settings, only affects engines created afterwards.
+        """
+        if poolsize is not None:
+            self.poolsize = poolsize
+        if maxoverflow is not None:
+            self.maxoverflow = maxoverflow
+        if preping is not None:
+            self.preping = preping
+        if recycle is not None:
+            self.recycle = recycle
+
+    def route_reads(self, uri, replicauri):
+        """
+        Read only helpers called with 'uri' will run against 'replicauri'.
+        Pass a replicauri of None to stop routing.
+        """
+        if replicauri is None:
+            self.replicas.pop(uri, None)
+        else:
+            self.replicas[uri] = replicauri
+
+    def read_uri(self, uri):
+        return self.replicas.get(uri, uri)
+
+    @staticmethod
+    def is_pooled(uri):
+        return not uri.startswith('sqlite')
+
+    def _registered(self, uri):
+        """
+        Creates the engine (and for pooled uris the Database) of 'uri' if
+        needed, the caller holds the lock.
+        """
+        if self._pid != os.getpid():
+            self._engines = {}
+            self._databases = {}
+            self._pid = os.getpid()
+        if uri in self._engines:
+            return
+        engine_kwargs = {'pool_recycle': self.recycle,
+                         'pool_pre_ping': self.preping,
+                         }
+        if self.is_pooled(uri):
+            engine_kwargs.update({'pool_size': self.poolsize,
+                                  'max_overflow': self.maxoverflow,
+                                  'convert_unicode': True,
+                                  'encoding': 'utf-8',
+                                  })
+            database = Database(url=uri, reflect_metadata=False,
+                                engine_kwargs=engine_kwargs)
+            self._databases[uri] = database
+            self._engines[uri] = database.engine
+        else:
+            self._engines[uri] = create_engine(uri, **engine_kwargs)
+
+    def engine(self, uri):
+        with self._lock:
+            self._registered(uri)
+            return self._engines[uri]
+
+    def database(self, uri):
+        """
+        The process wide dataset.Database for a pooled 'uri'. It keeps one
+        transaction per thread, so it can be shared like the engine.
+        """
+        if not self.is_pooled(uri):
+            raise ValueError('sqlite uris are not pooled: ' + uri)
+        with self._lock:
+            self._registered(uri)
+            return self._databases[uri]
+
+    @contextmanager
+    def connection(self, uri):
+        """
+        Checks a DBAPI connection out of the pool, commits on success,
+        rolls back on error and always returns it to the pool.
+        """
+        con = self.engine(uri).raw_connection()
+        try:
+            yield con
+            con.commit()
+        except:
+            con.rollback()
+            raise
+        finally:
+            con.close()
+
+    def dispose(self):
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines = {}
+            self._databases = {}
+
+
+ENGINES = EngineRegistry()
+
+
+class S3ClientRegistry(object):
+    """
+    Process wide cache of boto3 s3 clients, so stashes and flushes reuse
+    clients (and their open connections) instead of building new ones,
+    which takes hundreds of milliseconds each.
+
+    Clients are keyed by their connection pool size: ask for one with
+    'maxconnections' at least the number of threads that will share it,
+    otherwise threads queue for botocore's default of 10 connections.
+
+    retrymode - botocore retry mode ('legacy', 'standard' or 'adaptive').
+    maxattempts - attempts per request, including the first one.
+    tcpkeepalive - keep idle pooled connections alive.
+
+    Like ENGINES, the cache (and the boto3 session behind it) is rebuilt in
+    forked children, since clients can't be shared across processes.
+    """
+    def __init__(self, retrymode='standard', maxattempts=5,
+                 tcpkeepalive=True):
+        self.retrymode = retrymode
+        self.maxattempts = maxattempts
+        self.tcpkeepalive = tcpkeepalive
+        self._clients = {}
+        self._session = None
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def configure(self, retrymode=None, maxattempts=None, tcpkeepalive=None):
+        """
+        Changes the client settings, only affects clients created afterwards.
+        """
+        if retrymode is not None:
+            self.retrymode = retrymode
+        if maxattempts is not None:
+            self.maxattempts = maxattempts
+        if tcpkeepalive is not None:
+            self.tcpkeepalive = tcpkeepalive
+
+    def config(self, maxconnections=10):
+        options = {'signature_version': 's3v4',
+                   'max_pool_connections': maxconnections,
+                   'retries': {'mode': self.retrymode,
+                               'total_max_attempts': self.maxattempts},
+                   }
+        # tcp_keepalive needs botocore >= 1.21.
+        if 'tcp_keepalive' in Config.OPTION_DEFAULTS:
+            options['tcp_keepalive'] = self.tcpkeepalive
+        return Config(**options)
+
+    def client(self, maxconnections=10):
+        # Sessions aren't thread safe, hence one session and the lock.
+        with self._lock:
+            if self._pid != os.getpid():
+                self._clients = {}
+                self._session = None
+                self._pid = os.getpid()
+            key = (maxconnections, self.retrymode, self.maxattempts,
+                   self.tcpkeepalive)
+            try:
+                return self._clients[key]
+            except KeyError:
+                if self._session is None:
+                    self._session = boto3.session.Session()
+                client = self._session.client('s3',
+                                              config=self.config(maxconnections))
+                self._clients[key] = client
+                return client
+
+    def clear(self):
+        with self._lock:
+            self._clients = {}
+            self._session = None
+
+
+S3CLIENTS = S3ClientRegistry()
+
+
 # -------------------------------------
 # PSQL
 
 
 def psql_query(query, params={}, url=DEFAULTDB):
-    with psyconnect(url) as con:
+    with ENGINES.connection(ENGINES.read_uri(url)) as con:
         curs = con.cursor(cursor_factory=DictCursor)
         curs.execute(query, params)
         return [dict(r) for r in curs]
 
 
 def psql_query_no_return(query, params={}, url=DEFAULTDB):
-    with psyconnect(url) as con:
+    with ENGINES.connection(url) as con:
         curs = con.cursor(cursor_factory=DictCursor)
         curs.execute(query, params)
 
 
 def dataset_query(table, url=DEFAULTDB, **xargs):
-    with Database(url=url) as db:
+    url = ENGINES.read_uri(url)
+    if ENGINES.is_pooled(url):
+        db = ENGINES.database(url)
+    else:
+        db = Database(url=url)
+    with db:
         return (r for r in db[table].find(**xargs))
 
 
@@ -270,6 +495,68 @@ def check_n_prep_path(filepath):
             filepathobj.mkdir(parents=True)
 
 
+# ------------------------------------------------------------------------------
+# Threading Utils
+
+_STOPWORKER = object()
+
+
+class BackgroundWorker(object):
+    """
+    Applies 'func' to items placed on a bounded queue from a dedicated thread.
+
+    put blocks while 'queuedepth' items are already waiting (back-pressure).
+    The first exception raised by func is re-raised, with its traceback, on
+    the next call to put or close; items queued after a failure are dropped
+    until the error has been re-raised.
+    close waits until the queue has been drained.
+    """
+    def __init__(self, func, queuedepth=100, name=None):
+        self.func = func
+        self.queue = queue.Queue(maxsize=queuedepth)
+        self.excinfo = None
+        self.thread = threading.Thread(target=self._run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is _STOPWORKER:
+                    return
+                if self.excinfo is None:
+                    self.func(item)
+            except Exception:
+                self.excinfo = sys.exc_info()
+                LOG.error('BackgroundWorker ' + str(self.thread.name) +
+                          ' failed:\t' + repr(self.excinfo[1]))
+            finally:
+                self.queue.task_done()
+
+    def raise_error(self):
+        if self.excinfo is not None:
+            excinfo, self.excinfo = self.excinfo, None
+            reraise(*excinfo)
+
+    def put(self, item):
+        self.raise_error()
+        self.queue.put(item)
+
+    def join(self):
+        """
+        Blocks until every item placed so far has been processed.
+        """
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(_STOPWORKER)
+            self.thread.join()
+        self.raise_error()
+
+
 # ------------------------------------------------------------------------------
 # Misc. Utils
 
@@ -289,8 +576,15 @@ def pass_through(stuff):
     return stuff
 
 
+_FERNETS = {}
+
+
 def encrypt_it(content, key):
-    ferob = Fernet(str(key))
+    # Fernet objects are stateless, so one per key is kept for the process.
+    try:
+        ferob = _FERNETS[key]
+    except KeyError:
+        ferob = _FERNETS[key] = Fernet(str(key))
     return ferob.encrypt(str(content))
 
 
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Steven Cutting'
+__author_email__ = 'steven.c.projects@gmail.com'
+__created_on__ = '8/31/2015'
+__copyright__ = "superserial  Copyright (C) 2015  Steven Cutting"
+
+from superserial import(__title__, __version__, __status__, __license__,
+                        __maintainer__, __email__)
+
+
+import os
+from StringIO import StringIO
+
+import pytest
+
+from superserial.outsidemodules.parallel_easy import(parallel_apply,
+                                                     imap_easy,
+                                                     map_easy,
+                                                     WorkerPool,
+                                                     default_pool,
+                                                     shutdown_default_pool,
+                                                     ChunkSizer,
+                                                     map_easy_padded_blocks)
+
+
+def length_or_double(x):
+    if isinstance(x, str):
+        return len(x)
+    return 2 * x
+
+
+def fail_on_5(x):
+    if x == 5:
+        raise KeyError(x)
+    return x
+
+
+def test_parallel_apply_batches_and_large_payloads():
+    out = StringIO()
+    parallel_apply(length_or_double, xrange(1000), 3, out_stream=out,
+                   batchsize=7)
+    assert sorted(int(x) for x in out.getvalue().split()) == range(0, 2000, 2)
+    out = StringIO()
+    parallel_apply(length_or_double, ['x' * 100000] * 5 + ['y'], 2,
+                   out_stream=out, shmthreshold=1000)
+    assert sorted(out.getvalue().split()) == ['1'] + ['100000'] * 5
+
+
+def test_parallel_apply_reraises_worker_errors():
+    try:
+        parallel_apply(fail_on_5, xrange(20), 2, out_stream=StringIO())
+    except RuntimeError as e:
+        assert 'KeyError' in str(e)
+    else:
+        raise AssertionError('the worker error was not re-raised')
+
+
+def record_pid(x):
+    return os.getpid()
+
+
+def set_marker(value):
+    global MARKER
+    MARKER = value
+
+
+def read_marker(x):
+    return MARKER
+
+
+def test_WorkerPool_reuses_processes_and_runs_initializers():
+    with WorkerPool(2, initializer=set_marker, initargs=('ready',)) as pool:
+        first = set(map_easy(record_pid, range(50), 2, pool=pool))
+        second = set(imap_easy(record_pid, range(50), 2, 5, pool=pool))
+        assert first | second <= set(p.pid for p in pool.pool._pool)
+        assert set(map_easy(read_marker, range(10), 2, pool=pool)) == {'ready'}
+    assert pool._pool is None
+    assert default_pool() is default_pool()
+    shutdown_default_pool()
+
+
+def test_imap_easy_maxinflight_bounds_input():
+    consumed = []
+
+    def source():
+        for x in xrange(10000):
+            consumed.append(x)
+            yield x
+
+    for ordered in (True, False):
+        del consumed[:]
+        results = imap_easy(length_or_double, source(), 2, 10,
+                            ordered=ordered, maxinflight=3)
+        first = [next(results) for _ in range(5)]
+        assert len(consumed) <= 50
+        rest = list(results)
+        assert sorted(first + rest) == range(0, 20000, 2)
+        if ordered:
+            assert first + rest == range(0, 20000, 2)
+    try:
+        list(imap_easy(fail_on_5, xrange(100), 2, 3, ordered=False,
+                       maxinflight=2))
+    except KeyError:
+        pass
+    else:
+        raise AssertionError('the worker error was not re-raised')
+
+
+def test_ChunkSizer_targets_task_time_and_balances_tail():
+    sizer = ChunkSizer(2, total=10000, targetseconds=0.1)
+    assert sizer.next_size() == 1
+    sizer.submitting(range(1))
+    sizer.record(1, 0.001)
+    sizes = [sizer.next_size() for _ in range(10)]
+    assert sizes[:3] == [2, 4, 8] and sizes[-1] == 100
+    sizer.submitted = 9900
+    assert sizer.next_size() == 25
+    assert map_easy(length_or_double, range(500), 2,
+                    chunksize='auto') == range(0, 1000, 2)
+
+
+def rightmax(values):
+    return [max(values[i: i + 2]) for i in range(len(values))]
+
+
+def rowsums(rows):
+    return [int(row.sum()) for row in rows]
+
+
+def test_map_easy_padded_blocks_numpy_shared(tmpdir):
+    numpy = pytest.importorskip('numpy')
+    values = numpy.random.RandomState(0).randint(0, 100, 5000)
+    benchmark = rightmax(list(values))
+    result = map_easy_padded_blocks(rightmax, values, 3, 1, blocksize=300,
+                                    shared=True)
+    assert isinstance(result, numpy.ndarray)
+    assert list(result) == benchmark
+    inmap = numpy.memmap(str(tmpdir.join('in')), dtype=values.dtype,
+                         mode='w+', shape=values.shape)
+    inmap[:] = values
+    out = numpy.memmap(str(tmpdir.join('out')), dtype=values.dtype,
+                       mode='w+', shape=values.shape)
+    assert map_easy_padded_blocks(rightmax, inmap, 2, 1, blocksize=700,
+                                  shared=True, out=out) is out
+    assert list(out) == benchmark
+    assert map_easy_padded_blocks(rightmax, list(values), 2, 1) == benchmark
+    # Without shared, arrays go through the list path as before.
+    assert map_easy_padded_blocks(rightmax, values, 2, 1) == benchmark
+    rows = numpy.arange(40).reshape(20, 2)
+    assert map_easy_padded_blocks(rowsums, rows, 2, 1, blocksize=5) == \
+        rowsums(rows)
+    with pytest.raises(ValueError):
+        map_easy_padded_blocks(rowsums, rows, 2, 1, shared=True)
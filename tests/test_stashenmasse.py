@@ -14,8 +14,11 @@ LOG = logging.getLogger(__name__)
 LOGFMT = '''%(levelname)s\tproc:%(process)d thread:%(thread)d module:%(module)s\
 \t%(message)s'''
 
-from superserial.stashenmasse import EnMasseStash
-from superserial import Gula
+import dataset
+from concurrent.futures import ThreadPoolExecutor
+
+from superserial.stashenmasse import EnMasseStash, stash_en_masse
+from superserial import Gula, AsyncGula, SQLStash, file_stash
 
 
 class TestStashObj(object):
@@ -60,6 +63,146 @@ def test_Gula_basic_with_TestStashObj_as_context_mnger():
         testinst.test({'test': 'foo'})
 
 
+class CollectingStashObj(TestStashObj):
+    def __init__(self, **xargs):
+        super(CollectingStashObj, self).__init__(**xargs)
+        self.stashed = []
+        self.closed = False
+
+    def stash(self, datumdict):
+        self.stashed.append(datumdict)
+
+    def close(self):
+        self.closed = True
+
+
+class BatchingStashObj(CollectingStashObj):
+    def __init__(self, **xargs):
+        super(BatchingStashObj, self).__init__(**xargs)
+        self.batches = []
+
+    def stash_many(self, datumdicts):
+        self.batches.append(len(datumdicts))
+        self.stashed.extend(datumdicts)
+
+
+class FailingStashObj(TestStashObj):
+    def stash(self, datumdict):
+        raise IOError('stash failed')
+
+
+def test_AsyncGula_consume_with_sync_stash_objs():
+    text, raw = CollectingStashObj(), CollectingStashObj()
+    with AsyncGula(maxinflight=4, text=text, raw=raw) as testinst:
+        testinst.consume(({'id': i, 'text': i, 'raw': -i} for i in range(50)))
+    assert text.stashed == range(50)
+    assert sorted(raw.stashed) == sorted(-i for i in range(50))
+    assert text.closed and raw.closed
+
+
+def test_AsyncGula_consume_futures():
+    text = CollectingStashObj()
+    executor = ThreadPoolExecutor(max_workers=2)
+    futures = [executor.submit(dict, text=i) for i in range(10)]
+    with AsyncGula(text=text) as testinst:
+        testinst.consume(futures)
+    executor.shutdown()
+    assert sorted(text.stashed) == range(10)
+
+
+def test_AsyncGula_reraises_stash_errors():
+    testinst = AsyncGula(test=FailingStashObj())
+    testinst.stash({'test': 'foo'})
+    try:
+        testinst.close()
+    except IOError:
+        pass
+    else:
+        raise AssertionError('IOError was not re-raised by close')
+
+
+def test_Gula_queued_drains_on_close():
+    text, raw = CollectingStashObj(), CollectingStashObj()
+    with Gula.queued(queuedepth=2, text=text, raw=raw) as testinst:
+        testinst.consume(({'id': i, 'text': i, 'raw': -i} for i in range(50)))
+    assert text.stashed == range(50)
+    assert raw.stashed == [-i for i in range(50)]
+    assert text.closed and raw.closed
+
+
+def test_AsyncGula_with_SQLStash(tmpdir):
+    uri = 'sqlite:///' + str(tmpdir.join('meta.db'))
+    with AsyncGula(meta=SQLStash(uri, table='meta', chuncksize=2)) as testinst:
+        testinst.consume(({'meta': {'id': str(i), 'n': i}} for i in range(9)))
+    table = dataset.connect(uri)['meta']
+    assert sorted(row['n'] for row in table.all()) == range(9)
+
+
+def test_Gula_queued_with_SQLStash(tmpdir):
+    uri = 'sqlite:///' + str(tmpdir.join('meta.db'))
+    with Gula.queued(meta=SQLStash(uri, table='meta',
+                                   chuncksize=2)) as testinst:
+        testinst.consume(({'meta': {'id': str(i), 'n': i}} for i in range(9)))
+    table = dataset.connect(uri)['meta']
+    assert sorted(row['n'] for row in table.all()) == range(9)
+
+
+def test_Gula_queued_reraises_stash_errors_and_closes_all():
+    raw = CollectingStashObj()
+    testinst = Gula.queued(test=FailingStashObj(), raw=raw)
+    testinst.stash({'test': 'foo', 'raw': 'bar'})
+    try:
+        testinst.close()
+    except IOError:
+        pass
+    else:
+        raise AssertionError('IOError was not re-raised by close')
+    assert raw.stashed == ['bar'] and raw.closed
+
+
+def test_Gula_consume_uses_stash_many_and_fallback():
+    text, raw = BatchingStashObj(), CollectingStashObj()
+    with Gula(text=text, raw=raw) as testinst:
+        testinst.consume(({'id': i, 'text': i, 'raw': -i} for i in range(25)),
+                         batchsize=10)
+    assert text.batches == [10, 10, 5]
+    assert text.stashed == range(25)
+    assert raw.stashed == [-i for i in range(25)]
+
+
+def test_Gula_consume_resume(tmpdir):
+    outdir = tmpdir.join('out')
+    manifestpath = str(tmpdir.join('manifest.sqlite'))
+    datums = [{'id': i, 'text': {'pointer': u'%s/%d.txt' % (outdir, i),
+                                 'content': 'text %d' % i}}
+              for i in range(10)]
+    with Gula(text=file_stash('file://' + str(outdir),
+                              manifest=manifestpath)) as gula:
+        gula.consume(datums[:6])
+    outdir.join('0.txt').remove()
+    with Gula(text=file_stash('file://' + str(outdir),
+                              manifest=manifestpath)) as gula:
+        gula.consume(datums, resume=True)
+    assert not outdir.join('0.txt').exists()
+    assert sorted(p.basename for p in outdir.listdir()) == [
+        '%d.txt' % i for i in range(1, 10)]
+
+
+def test_Gula_consume_resume_ignores_stashed_attributes():
+    text = CollectingStashObj()
+    with Gula(text=text) as gula:
+        gula.consume(({'id': i, 'text': i} for i in range(5)), resume=True)
+    assert text.stashed == range(5)
+
+
+def test_stash_en_masse_batches():
+    text = BatchingStashObj()
+    stash_en_masse(({'id': i, 'text': i} for i in range(7)), {'text': text},
+                   batchsize=3)
+    assert text.batches == [3, 3, 1]
+    assert text.closed
+
+
 if __name__ == '__main__':
     logging.basicConfig(format=LOGFMT,
                         level=logging.DEBUG,
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Steven Cutting'
+__author_email__ = 'steven.c.projects@gmail.com'
+__created_on__ = '8/31/2015'
+__copyright__ = "superserial  Copyright (C) 2015  Steven Cutting"
+
+from superserial import(__title__, __version__, __status__, __license__,
+                        __maintainer__, __email__)
+
+
+import os
+import tarfile
+from io import BytesIO
+
+import pytest
+from pathlib import Path
+from cryptography.fernet import Fernet
+from cryptography.exceptions import InvalidTag
+
+from superserial import file_stash, PackFileStash, PackFileReader
+from superserial import stashtofile
+from superserial.stashtofile import(parse_size, fanout_path, s3_stash_object,
+                                    s3_stash_objects_threaded, S3Uploader)
+from superserial.envelope import(get_codec, CODECS, make_stream_envelope,
+                                 AeadCipher, aead_decrypt)
+from superserial.utils import S3ClientRegistry
+from superserial.stashindex import DedupIndex, Manifest, content_hash
+
+
+def test_parse_size():
+    assert parse_size(10) == 10
+    assert parse_size('64MB') == 64 * 1024 ** 2
+    assert parse_size('512k') == 512 * 1024
+
+
+def test_PackFileStash_roundtrip_and_rolling(tmpdir):
+    parenturi = 'file://' + str(tmpdir) + '/?pack=4KB'
+    contents = dict((u'/text/%d.txt' % i, 'content %d ' % i * (i + 1))
+                    for i in range(100))
+    with file_stash(parenturi) as stashobj:
+        assert isinstance(stashobj, PackFileStash)
+        stashobj.stash_many([{'pointer': k, 'content': v}
+                             for k, v in sorted(contents.items())])
+    segments = tmpdir.listdir('*.tar')
+    assert len(segments) > 1
+    assert all(tarfile.is_tarfile(str(s)) for s in segments)
+    reader = PackFileReader('file://' + str(tmpdir))
+    assert len(reader) == len(contents)
+    for pointer, content in contents.items():
+        assert reader.get(pointer) == content
+
+
+def test_PackFileStash_no_empty_segments(tmpdir):
+    with file_stash('file://' + str(tmpdir) + '/?pack=1KB') as stashobj:
+        stashobj.stash({'pointer': u'/text/big.txt', 'content': 'x' * 2048})
+        try:
+            stashobj.stash({'pointer': u'/text/a\tb.txt', 'content': 'foo'})
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('a pointer with a tab was accepted')
+    assert len(tmpdir.listdir('*.tar')) == 1
+    assert len(tmpdir.listdir('*.idx')) == 1
+    assert len(PackFileReader('file://' + str(tmpdir))) == 1
+
+
+def test_PackFileStash_s3_uploads_segment_paths(monkeypatch):
+    client = RecordingS3Client()
+    monkeypatch.setattr(stashtofile.S3CLIENTS, 'client',
+                        lambda maxconnections=None: client)
+    with file_stash('s3://b/packs/?pack=1KB', kmsencrypt=False) as stashobj:
+        stashobj.stash_many([{'pointer': u'/text/%d.txt' % i,
+                              'content': 'x' * 600} for i in range(4)])
+    # One segment and its index per datum, no empty trailing segment.
+    assert [call[0] for call in client.calls] == ['upload_fileobj'] * 8
+    assert not any(call[2] == b'' for call in client.calls)
+
+
+def test_LocalFileStash_threaded_batch_durability(tmpdir):
+    with file_stash('file://' + str(tmpdir), writers=4,
+                    durability='batch') as stashobj:
+        stashobj.stash_many([{'pointer': u'%s/%d.txt' % (tmpdir, i),
+                              'content': u'caf\xe9 %d' % i}
+                             for i in range(50)])
+    assert sorted(p.basename for p in tmpdir.listdir()) == sorted(
+        '%d.txt' % i for i in range(50))
+    assert tmpdir.join('7.txt').read_binary() == u'caf\xe9 7'.encode('utf-8')
+
+
+def test_LocalFileStash_reraises_writer_errors(tmpdir):
+    stashobj = file_stash('file://' + str(tmpdir), writers=2)
+    stashobj.stash({'pointer': u'%s/missing/dir/1.txt' % tmpdir,
+                    'content': 'foo'})
+    try:
+        stashobj.close()
+    except IOError:
+        pass
+    else:
+        raise AssertionError('IOError was not re-raised by close')
+
+
+def test_LocalFileStash_fanout(tmpdir):
+    pointers = [u'%s/%d.txt' % (tmpdir, i) for i in range(20)]
+    with file_stash('file://' + str(tmpdir), fanout=2) as stashobj:
+        stashobj.stash_many([{'pointer': p, 'content': 'foo'}
+                             for p in pointers])
+    for pointer in pointers:
+        path = fanout_path(pointer)
+        assert len(path.split('/')) == len(pointer.split('/')) + 2
+        assert open(path).read() == 'foo'
+    assert fanout_path(u'/out/text/1.txt', levels=0) == u'/out/text/1.txt'
+
+
+@pytest.mark.parametrize('name, workers, n', [('gzip', 2, 5),
+                                                ('zstd', 8, 400)])
+def test_LocalFileStash_compress(tmpdir, name, workers, n):
+    try:
+        codec = get_codec(name)
+    except ImportError:
+        pytest.skip(name + ' is not installed')
+    with file_stash('file://' + str(tmpdir), compress=name,
+                    compressworkers=workers) as stashobj:
+        stashobj.stash_many([{'pointer': u'%s/%d.txt' % (tmpdir, i),
+                              'content': u'caf\xe9 ' * 100}
+                             for i in range(n)])
+    assert sorted(p.basename for p in tmpdir.listdir()) == sorted(
+        '%d.txt%s' % (i, codec.extension) for i in range(n))
+    data = tmpdir.join('3.txt' + codec.extension).read_binary()
+    assert len(data) < 100
+    assert codec.decompress(data) == (u'caf\xe9 ' * 100).encode('utf-8')
+
+
+def test_codecs_roundtrip_streaming():
+    for name in CODECS:
+        try:
+            codec = get_codec(name, level=1)
+        except ImportError:
+            continue
+        compressor = codec.compressobj()
+        data = compressor.compress(b'abc' * 1000) + compressor.flush()
+        assert codec.decompress(data) == b'abc' * 1000
+
+
+class RecordingS3Client(object):
+    def __init__(self):
+        self.calls = []
+
+    def put_object(self, **kwargs):
+        if kwargs['Key'] == 'bad':
+            raise IOError('bad key')
+        self.calls.append(('put_object', kwargs['Key'], kwargs['Body']))
+        return {}
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None,
+                       Config=None):
+        self.calls.append(('upload_fileobj', key, fileobj.read()))
+        assert ExtraArgs['ACL'] == 'private'
+
+
+def test_s3_stash_object_multipart_threshold(tmpdir):
+    client = RecordingS3Client()
+    args = dict(bucket='b', client=client, kmsencrypt=False,
+                multipartthreshold=10)
+    s3_stash_object(key='small', body=b'abc', **args)
+    s3_stash_object(key='big', body=b'abc' * 10, **args)
+    path = tmpdir.join('f.txt')
+    path.write_binary(b'xyz')
+    s3_stash_object(key='path', body=Path(str(path)), **args)
+    assert client.calls == [('put_object', 'small', b'abc'),
+                            ('upload_fileobj', 'big', b'abc' * 10),
+                            ('upload_fileobj', 'path', b'xyz')]
+
+
+def test_s3_stash_objects_threaded_nested(monkeypatch):
+    client = RecordingS3Client()
+    monkeypatch.setattr(stashtofile.S3CLIENTS, 'client',
+                        lambda maxconnections=None: client)
+    results = s3_stash_objects_threaded([(('a', '1'), ('b', '2'), ('c', '3')),
+                                         ('d', '4')],
+                                        bucket='b', threads=2,
+                                        kmsencrypt=False)
+    assert len(results) == 4
+    assert sorted(call[1] for call in client.calls) == ['a', 'b', 'c', 'd']
+
+
+def test_stream_envelope_compresses_on_read():
+    codec = get_codec('gzip')
+    reader = make_stream_envelope(codec=codec)(BytesIO(b'abc' * 10000))
+    chunks = []
+    while True:
+        chunk = reader.read(100)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    assert codec.decompress(b''.join(chunks)) == b'abc' * 10000
+
+
+def test_S3Uploader_drains_and_reports_results():
+    client = RecordingS3Client()
+    uploader = S3Uploader('b', threads=4, queuedepth=2, client=client)
+    uploader.put_many(('%d' % i, b'x') for i in range(50))
+    uploader.put('bad', b'x')
+    try:
+        uploader.close()
+    except IOError:
+        pass
+    else:
+        raise AssertionError('the failed upload was not re-raised')
+    assert len(client.calls) == 50
+    assert (uploader.uploaded, uploader.failed) == (50, 1)
+    assert [result.key for result in uploader.results] == ['bad']
+    keeping = S3Uploader('b', threads=2, client=client, keepresults=True)
+    keeping.put_many(('%d' % i, b'x') for i in range(5))
+    assert len(keeping.close()) == 5
+
+
+def test_S3ClientRegistry_reuses_clients_per_process():
+    registry = S3ClientRegistry(retrymode='adaptive', maxattempts=3)
+    client = registry.client(maxconnections=50)
+    assert registry.client(maxconnections=50) is client
+    assert registry.client() is not client
+    assert client.meta.config.max_pool_connections == 50
+    assert client.meta.config.retries == {'mode': 'adaptive',
+                                          'total_max_attempts': 3}
+    registry._pid = -1
+    assert registry.client(maxconnections=50) is not client
+
+
+def test_LocalFileStash_dedup(tmpdir):
+    indexpath = str(tmpdir.join('index', 'dedup.sqlite'))
+    outdir = tmpdir.join('out')
+    datums = [{'pointer': u'%s/%d.txt' % (outdir, i), 'content': 'same'}
+              for i in range(5)]
+    datums.append({'pointer': u'%s/other.txt' % outdir, 'content': 'other'})
+    with file_stash('file://' + str(outdir), dedup=indexpath) as stashobj:
+        stashobj.stash_many(datums)
+    assert sorted(p.basename for p in outdir.listdir()) == ['0.txt',
+                                                            'other.txt']
+    index = DedupIndex(indexpath)
+    assert index.resolve(u'%s/3.txt' % outdir) == u'%s/0.txt' % outdir
+    assert not index.claim(u'%s/9.txt' % outdir, 'same')
+    assert index.claim(u'%s/0.txt' % outdir, 'changed')
+    assert content_hash(u'caf\xe9') == content_hash(u'caf\xe9'.encode('utf-8'))
+
+
+@pytest.mark.parametrize('writers', [1, 2])
+def test_LocalFileStash_dedup_failed_write_is_forgotten(tmpdir, writers):
+    indexpath = str(tmpdir.join('dedup.sqlite'))
+    outdir = tmpdir.join('out')
+    stashobj = file_stash('file://' + str(outdir), dedup=indexpath,
+                          writers=writers)
+    stashobj.stash({'pointer': u'%s/a.txt' % outdir, 'content': 'same'})
+    stashobj.stash({'pointer': u'%s/b.txt' % outdir, 'content': 'same'})
+    with pytest.raises(IOError):
+        # A writer thread's error surfaces on close.
+        stashobj.stash({'pointer': u'%s/missing/c.txt' % outdir,
+                        'content': 'foo'})
+        stashobj.close()
+    if writers == 1:
+        stashobj.close()
+    index = DedupIndex(indexpath)
+    assert index.resolve(u'%s/b.txt' % outdir) == u'%s/a.txt' % outdir
+    assert outdir.join('a.txt').read() == 'same'
+    assert index.claim(u'%s/d.txt' % outdir, 'foo')
+
+
+def test_DedupIndex_commits_when_no_write_is_in_flight(tmpdir):
+    indexpath = str(tmpdir.join('dedup.sqlite'))
+    index = DedupIndex(indexpath, commitevery=2)
+    assert index.claim('a', 'x')
+    assert not index.claim('b', 'x')
+    assert DedupIndex(indexpath).resolve('b') == 'b'
+    index.stored('a')
+    assert DedupIndex(indexpath).resolve('b') == 'a'
+
+
+def test_DedupIndex_overwrite_relocates_shared_content(tmpdir):
+    indexpath = str(tmpdir.join('dedup.sqlite'))
+    outdir = tmpdir.join('out')
+    p1, p2 = u'%s/1.txt' % outdir, u'%s/2.txt' % outdir
+    with file_stash('file://' + str(outdir), dedup=indexpath,
+                    writers=2) as stashobj:
+        stashobj.stash_many([{'pointer': p1, 'content': 'X'},
+                             {'pointer': p2, 'content': 'X'}])
+        stashobj.stash({'pointer': p1, 'content': 'Y'})
+    index = DedupIndex(indexpath)
+    assert index.resolve(p2) == p2
+    assert outdir.join('2.txt').read() == 'X'
+    assert outdir.join('1.txt').read() == 'Y'
+    assert index.claim(p2, 'Z')
+    assert index.pop_relocations() == []
+
+
+class ListingS3Client(object):
+    class Paginator(object):
+        def paginate(self, Bucket, Prefix):
+            assert (Bucket, Prefix) == ('b', 'text/')
+            yield {'Contents': [{'Key': 'text/1.txt'}, {'Key': 'text/2.txt'}]}
+            yield {}
+
+    def get_paginator(self, name):
+        assert name == 'list_objects_v2'
+        return self.Paginator()
+
+
+def test_Manifest_seed_s3(tmpdir):
+    manifest = Manifest(str(tmpdir.join('manifest.sqlite')))
+    assert manifest.seed_s3(ListingS3Client(), 'b', prefix='text/') == 2
+    assert 'text/2.txt' in manifest
+    assert 'text/3.txt' not in manifest
+    assert len(manifest) == 2
+
+
+def test_LocalFileStash_encryption_stage(tmpdir):
+    key = Fernet.generate_key()
+    with file_stash('file://' + str(tmpdir), encrypt=True, encryptkey=key,
+                    compress='gzip', encryptworkers=2) as stashobj:
+        stashobj.stash_many([{'pointer': u'%s/%d.txt' % (tmpdir, i),
+                              'content': 'secret %d' % i}
+                             for i in range(100)])
+        stats = stashobj.compressexecutor.stats()
+    assert stats['items'] == 100
+    assert stats['batches'] == 2
+    codec = get_codec('gzip')
+    for i in (0, 99):
+        data = Fernet(key).decrypt(tmpdir.join(str(i)).read_binary())
+        assert codec.decompress(data) == 'secret %d' % i
+
+
+def test_S3FileStashPool_close_shuts_down_compressexecutor(monkeypatch):
+    client = RecordingS3Client()
+    monkeypatch.setattr(stashtofile.S3CLIENTS, 'client',
+                        lambda maxconnections=None: client)
+    with file_stash('s3://b/text', pool=True, threads=2, compress='gzip',
+                    compressworkers=2) as stashobj:
+        stashobj.stash_many([{'pointer': 's3://b/text/%d.txt' % i,
+                              'content': 'foo'} for i in range(10)])
+        executor = stashobj.compressexecutor
+    assert executor._shutdown
+    assert len(client.calls) == 10
+
+
+def test_AeadCipher_roundtrip_stream_and_range():
+    key = Fernet.generate_key()
+    cipher = AeadCipher(key, chunksize=1000)
+    plaintext = os.urandom(10000)
+    sealed = cipher.encrypt(plaintext)
+    # header + 10 chunks, no base64
+    assert len(sealed) == 25 + 10 * 20 + 10000
+    assert cipher.decrypt(sealed) == plaintext
+    reader = cipher.encrypt_stream(BytesIO(plaintext))
+    streamed = b''.join(iter(lambda: reader.read(333), b''))
+    assert b''.join(cipher.decrypt_chunks(BytesIO(streamed))) == plaintext
+    assert cipher.decrypt_range(BytesIO(sealed), 2500, 4100) == plaintext[2500:4100]
+    assert AeadCipher(key).decrypt(AeadCipher(key).encrypt(b'')) == b''
+    for broken in (sealed[:-1020], sealed[:100] + b'x' + sealed[101:]):
+        try:
+            cipher.decrypt(broken)
+        except (ValueError, InvalidTag):
+            pass
+        else:
+            raise AssertionError('tampering was not detected')
+
+
+@pytest.mark.parametrize('key', [None, 'None', 'short', u'caf\xe9',
+                                 Fernet.generate_key()[:-4]])
+def test_AeadCipher_rejects_bad_keys(key):
+    with pytest.raises(ValueError):
+        AeadCipher(key)
+
+
+def test_LocalFileStash_aead_envelope(tmpdir):
+    key = Fernet.generate_key()
+    with file_stash('file://' + str(tmpdir), encrypt=True, encryptkey=key,
+                    compress='zstd', envelope='aead') as stashobj:
+        stashobj.stash({'pointer': u'%s/1.txt' % tmpdir,
+                        'content': u'caf\xe9' * 100})
+    data = aead_decrypt(tmpdir.join('1').read_binary(), key)
+    assert get_codec('zstd').decompress(data) == (u'caf\xe9' * 100).encode('utf-8')
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Steven Cutting'
+__author_email__ = 'steven.c.projects@gmail.com'
+__created_on__ = '8/31/2015'
+__copyright__ = "superserial  Copyright (C) 2015  Steven Cutting"
+
+from superserial import(__title__, __version__, __status__, __license__,
+                        __maintainer__, __email__)
+
+
+import time
+import random
+
+from superserial.outsidemodules.threading_easy import threading_imap
+
+
+def slow_double(x):
+    time.sleep(random.random() / 1000.0)
+    return 2 * x
+
+
+def test_threading_imap_ordered_and_unordered():
+    assert list(threading_imap(slow_double, xrange(200), n_threads=8,
+                               chunksize=3)) == [2 * x for x in xrange(200)]
+    assert sorted(threading_imap(slow_double, xrange(200), n_threads=8,
+                                 ordered=False)) == [2 * x for x in xrange(200)]
+    assert list(threading_imap(slow_double, [], n_threads=4)) == []
+
+
+def test_threading_imap_backpressure_and_errors():
+    consumed = []
+
+    def source():
+        for x in xrange(1000):
+            consumed.append(x)
+            yield x
+
+    results = threading_imap(slow_double, source(), n_threads=2,
+                             maxinflight=4)
+    next(results)
+    time.sleep(0.05)
+    assert len(consumed) <= 6
+
+    def fail_on_7(x):
+        if x == 7:
+            raise KeyError(x)
+        return x
+    try:
+        list(threading_imap(fail_on_7, xrange(100), n_threads=4))
+    except KeyError:
+        pass
+    else:
+        raise AssertionError('the worker error was not re-raised')